@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Synthetic KOReader library for benchmarking: PDFs and EPUBs of configurable size, each with a matching
+.sdr/metadata.*.lua holding highlights that carry the noise real ones do (OCR-like character swaps,
+words hyphenated across lines and typographic ligatures).
+
+Usage: python3 benchmarks/corpus.py OUTPUT_DIR [--pages PAGES] [--highlights HIGHLIGHTS] [--seed SEED]
+"""
+import argparse
+import os
+import random
+import zipfile
+
+WORDS = ('the market economy labour capital theory practice knowledge figure field flow office reflect '
+         'define official profit conflict efficient specific influence difficult significant modern history '
+         'social power state question argument evidence method analysis structure relation between within '
+         'through however therefore although particular general important different example').split()
+
+# Typical OCR confusions, applied to highlight text only
+OCR_SWAPS = [('m', 'rn'), ('l', '1'), ('o', '0'), ('e', 'c'), ('h', 'b'), ('i', 'l')]
+LIGATURES = [('ffi', '\ufb03'), ('ffl', '\ufb04'), ('fi', '\ufb01'), ('fl', '\ufb02'), ('ff', '\ufb00')]
+
+LINE_CHARACTERS = 80
+LINES_PER_PAGE = 45
+
+def lua_string(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+def lua_value(value):
+    if isinstance(value, dict):
+        return '{ ' + ', '.join(f'[{lua_value(key)}] = {lua_value(item)}' for key, item in value.items()) + ' }'
+    if isinstance(value, list):
+        return '{\n' + ',\n'.join(f'[{index + 1}] = {lua_value(item)}' for index, item in enumerate(value)) + '\n}'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return lua_string(value)
+
+def write_metadata(sdr_directory, extension, metadata):
+    os.makedirs(sdr_directory, exist_ok=True)
+    with open(os.path.join(sdr_directory, f'metadata.{extension}.lua'), 'w', encoding='utf-8') as file:
+        file.write('-- we can read Lua syntax here!\nreturn ' + lua_value(metadata) + '\n')
+
+def make_lines(rng, count):
+    """Lines of running text, with a word hyphenated across the line break now and then."""
+    lines = []
+    carry = ''
+    while len(lines) < count:
+        line = carry
+        carry = ''
+        while True:
+            word = rng.choice(WORDS)
+            candidate = f'{line} {word}' if line else word
+            if len(candidate) <= LINE_CHARACTERS:
+                line = candidate
+                continue
+            if len(word) >= 6 and rng.random() < 0.3:
+                split = rng.randint(3, len(word) - 3)
+                if len(line) + split + 2 <= LINE_CHARACTERS:
+                    line = f'{line} {word[:split]}-'
+                    carry = word[split:]
+                    break
+            carry = word
+            break
+        lines.append(line)
+    return lines
+
+def page_words(lines):
+    """The words of some lines as a reader would copy them, with hyphenated words joined again."""
+    words = []
+    joined = False
+    for line in lines:
+        for index, word in enumerate(line.split()):
+            if joined and index == 0:
+                words[-1] = words[-1][:-1] + word
+            else:
+                words.append(word)
+            joined = False
+        joined = words[-1].endswith('-')
+    return words
+
+def add_noise(rng, text, ocr_rate):
+    for plain, ligature in LIGATURES:
+        if rng.random() < 0.5:
+            text = text.replace(plain, ligature)
+    characters = list(text)
+    for index, character in enumerate(characters):
+        if rng.random() < ocr_rate:
+            for original, replacement in OCR_SWAPS:
+                if character == original:
+                    characters[index] = replacement
+                    break
+    return ''.join(characters)
+
+def pick_highlight(rng, words, ocr_rate):
+    length = rng.randint(6, 30)
+    start = rng.randrange(0, max(1, len(words) - length))
+    return add_noise(rng, ' '.join(words[start:start + length]), ocr_rate)
+
+def annotation_entry(rng, index, page, text, pos0, pos1, chapter):
+    entry = {
+        'chapter': chapter,
+        'color': 'yellow',
+        'datetime': f'2024-01-{index % 28 + 1:02d} 10:{index % 60:02d}:00',
+        'drawer': 'lighten',
+        'page': page,
+        'pos0': pos0,
+        'pos1': pos1,
+        'text': text,
+    }
+    if rng.random() < 0.3:
+        entry['note'] = f'Note {index}: ' + ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+    return entry
+
+def generate_pdf(path, pages, highlights, seed=0, ocr_rate=0.02):
+    """
+    Writes a text PDF of the given number of pages and its .sdr/metadata.pdf.lua with the given number of highlights.
+
+    Args:
+        path: Where to write the PDF
+        pages: Number of pages
+        highlights: Number of highlights
+        seed: Seed for the random text and highlights
+        ocr_rate: Chance for each highlight character to be swapped for a look-alike
+    """
+    import fitz
+
+    rng = random.Random(seed)
+    doc = fitz.open()
+    page_lines = []
+    for _ in range(pages):
+        lines = make_lines(rng, LINES_PER_PAGE)
+        page_lines.append(lines)
+        page = doc.new_page()
+        for line_number, line in enumerate(lines):
+            page.insert_text((50, 60 + line_number * 16), line, fontsize=10)
+    doc.save(path, garbage=3, deflate=True)
+    doc.close()
+
+    annotations = []
+    for index in range(highlights):
+        page = rng.randint(1, pages)
+        text = pick_highlight(rng, page_words(page_lines[page - 1]), ocr_rate)
+        pos0 = {'page': page, 'x': 50.0 + index % 100, 'y': 60.0 + index % 40}
+        pos1 = {'page': page, 'x': 300.0 + index % 100, 'y': 80.0 + index % 40}
+        annotations.append(annotation_entry(rng, index, page, text, pos0, pos1, f'Chapter {(page - 1) // 10 + 1}'))
+    annotations.sort(key=lambda annotation: annotation['page'])
+
+    title = os.path.splitext(os.path.basename(path))[0]
+    write_metadata(os.path.splitext(path)[0] + '.sdr', 'pdf', {
+        'annotations': annotations,
+        'doc_props': {'authors': 'Synthetic Author', 'title': title},
+        'doc_pages': pages,
+        'stats': {'pages': pages, 'highlights': highlights, 'title': title},
+    })
+
+def format_paragraph(paragraph, words_per_line=12):
+    words = paragraph.split()
+    return '\n      '.join(' '.join(words[i:i + words_per_line]) for i in range(0, len(words), words_per_line))
+
+def generate_epub(path, chapters, highlights, seed=0, ocr_rate=0.02, paragraphs_per_chapter=30):
+    """
+    Writes an EPUB with the given number of chapters and its .sdr/metadata.epub.lua with the given number of
+    highlights, each with KOReader xpointers into the chapter that holds it.
+
+    Args:
+        path: Where to write the EPUB
+        chapters: Number of chapter documents
+        highlights: Number of highlights
+        seed: Seed for the random text and highlights
+        ocr_rate: Chance for each highlight character to be swapped for a look-alike
+        paragraphs_per_chapter: Number of paragraphs in each chapter
+    """
+    rng = random.Random(seed)
+    chapter_paragraphs = []
+    for _ in range(chapters):
+        chapter_paragraphs.append([' '.join(rng.choice(WORDS) for _ in range(rng.randint(40, 120))) for _ in range(paragraphs_per_chapter)])
+
+    title = os.path.splitext(os.path.basename(path))[0]
+    manifest = []
+    spine = []
+    with zipfile.ZipFile(path, 'w') as epub:
+        epub.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        epub.writestr('META-INF/container.xml', '<?xml version="1.0"?>\n<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>')
+        for chapter_index, paragraphs in enumerate(chapter_paragraphs):
+            # Paragraphs are laid out like formatted XHTML, across indented lines; KOReader's xpointer offsets below
+            # count the text with that whitespace collapsed
+            body = ''.join(f'<p>\n      {format_paragraph(paragraph)}\n    </p>\n' for paragraph in paragraphs)
+            epub.writestr(f'OEBPS/chapter{chapter_index + 1}.xhtml', f'<?xml version="1.0" encoding="utf-8"?>\n<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Chapter {chapter_index + 1}</title></head><body>\n<h1>Chapter {chapter_index + 1}</h1>\n{body}</body></html>')
+            manifest.append(f'<item id="chapter{chapter_index + 1}" href="chapter{chapter_index + 1}.xhtml" media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="chapter{chapter_index + 1}"/>')
+        epub.writestr('OEBPS/content.opf', f'<?xml version="1.0" encoding="utf-8"?>\n<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id"><metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:identifier id="id">{title}</dc:identifier><dc:title>{title}</dc:title><dc:creator>Synthetic Author</dc:creator><dc:language>en</dc:language></metadata><manifest>{"".join(manifest)}</manifest><spine>{"".join(spine)}</spine></package>')
+
+    # KOReader's page numbers for a reflowed book, assuming an even spread of characters over pages
+    chapter_lengths = [sum(len(paragraph) for paragraph in paragraphs) for paragraphs in chapter_paragraphs]
+    total_length = sum(chapter_lengths)
+    pages = max(1, total_length // 1500)
+
+    annotations = []
+    for index in range(highlights):
+        chapter_index = rng.randrange(chapters)
+        paragraph_index = rng.randrange(paragraphs_per_chapter)
+        words = chapter_paragraphs[chapter_index][paragraph_index].split()
+        length = rng.randint(4, min(25, len(words)))
+        start = rng.randrange(0, len(words) - length + 1)
+        exact = ' '.join(words[start:start + length])
+        start_offset = len(' '.join(words[:start])) + (1 if start else 0)
+        # DocFragment counts spine items from 1, and p[] counts from 1 after the heading
+        pointer = f'/body/DocFragment[{chapter_index + 1}]/body/p[{paragraph_index + 1}]/text()'
+        position = sum(chapter_lengths[:chapter_index]) + sum(len(paragraph) for paragraph in chapter_paragraphs[chapter_index][:paragraph_index]) + start_offset
+        page = min(pages, position * pages // total_length + 1)
+        text = add_noise(rng, exact, ocr_rate)
+        entry = annotation_entry(rng, index, page, text, f'{pointer}.{start_offset}', f'{pointer}.{start_offset + len(exact)}', f'Chapter {chapter_index + 1}')
+        # KOReader gives reflowed highlights their page number as pageno, which the Readest output reads
+        entry['pageno'] = page
+        annotations.append(entry)
+    annotations.sort(key=lambda annotation: annotation['page'])
+
+    write_metadata(os.path.splitext(path)[0] + '.sdr', 'epub', {
+        'annotations': annotations,
+        'doc_props': {'authors': 'Synthetic Author', 'title': title},
+        'doc_pages': pages,
+        'stats': {'pages': pages, 'highlights': highlights, 'title': title},
+    })
+
+def generate_corpus(directory, pages=100, highlights=200, seed=0, ocr_rate=0.02):
+    """Writes book.pdf and novel.epub with their sidecars into directory, returning both paths."""
+    # Marks the directory as an Obsidian vault, which the obsidian-annotator output needs
+    os.makedirs(os.path.join(directory, '.obsidian'), exist_ok=True)
+    pdf_path = os.path.join(directory, 'book.pdf')
+    epub_path = os.path.join(directory, 'novel.epub')
+    generate_pdf(pdf_path, pages, highlights, seed, ocr_rate)
+    generate_epub(epub_path, max(1, pages // 10), highlights, seed, ocr_rate)
+    return pdf_path, epub_path
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic KOReader library for benchmarking.')
+    parser.add_argument('directory', help='Directory to write the books and their .sdr sidecars to.')
+    parser.add_argument('--pages', type=int, default=100, help='Pages in the PDF; the EPUB gets one chapter per ten pages. Default is 100.')
+    parser.add_argument('--highlights', type=int, default=200, help='Highlights per book. Default is 200.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed. Default is 0.')
+    parser.add_argument('--ocr-rate', type=float, default=0.02, help='Chance for each highlight character to be swapped for a look-alike. Default is 0.02.')
+    args = parser.parse_args()
+    for path in generate_corpus(args.directory, args.pages, args.highlights, args.seed, args.ocr_rate):
+        print(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Times each stage of a kohico conversion on a synthetic corpus (see corpus.py) and writes the timings as JSON,
+so that runs on different commits can be compared.
+
+Usage: python3 benchmarks/run.py [--pages PAGES] [--highlights HIGHLIGHTS] [--repeat REPEAT] [--output OUTPUT] [--compare BASELINE]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import kohicolib
+import corpus
+
+# Writers timed on the PDF; readest is left out as it writes into Readest's own library
+PDF_WRITERS = ['obsidian-annotator', 'markdown', 'pdfplus', 'bake']
+
+def measure(repeat, work, setup=None, items=1):
+    """
+    Runs work repeat times, each time on a fresh value from setup (which is not timed), and summarises
+    wall and CPU time.
+    """
+    walls = []
+    cpus = []
+    for _ in range(repeat):
+        value = setup() if setup is not None else None
+        with contextlib.redirect_stdout(io.StringIO()):
+            wall_start = time.perf_counter()
+            cpu_start = time.process_time()
+            work(value)
+            cpus.append(time.process_time() - cpu_start)
+            walls.append(time.perf_counter() - wall_start)
+    return {
+        'wall_s': round(statistics.median(walls), 6),
+        'wall_min_s': round(min(walls), 6),
+        'cpu_s': round(statistics.median(cpus), 6),
+        'items': items,
+        'per_item_ms': round(statistics.median(walls) * 1000 / max(1, items), 4),
+        'runs': repeat,
+    }
+
+def warm_context(pdf_path, text_backend, page_numbers):
+    pdf_context = kohicolib.PdfContext(pdf_path, None, text_backend)
+    pdf_context.page_offsets
+    with contextlib.redirect_stdout(io.StringIO()):
+        pdf_context.load_text_contents(page_numbers)
+    return pdf_context
+
+def session_args(file_path, output_format, text_backend):
+    return argparse.Namespace(file_path=file_path, output_format=[output_format], template=None, no_cache=True, cache_size=256,
+                              text_backend=text_backend, full=True, incremental=False, jobs=1, profile=None, cprofile=None, trace_memory=False)
+
+def remove_outputs(directory):
+    for name in os.listdir(directory):
+        if name.endswith('.md') or name.endswith('_anno.pdf'):
+            os.remove(os.path.join(directory, name))
+
+def run_benchmarks(directory, pages, highlights, repeat, text_backend, seed):
+    pdf_path, epub_path = corpus.generate_corpus(directory, pages, highlights, seed)
+    pdf_lua = os.path.join(os.path.splitext(pdf_path)[0] + '.sdr', 'metadata.pdf.lua')
+    epub_lua = os.path.join(os.path.splitext(epub_path)[0] + '.sdr', 'metadata.epub.lua')
+    pdf_annotations = kohicolib.load_metadata_lua(pdf_lua)['annotations']
+    epub_metadata = kohicolib.load_metadata_lua(epub_lua)
+    page_numbers = sorted({annotation['page'] for annotation in pdf_annotations})
+
+    stages = {}
+    stages['lua_to_json'] = measure(repeat, lambda _: kohicolib.load_metadata_lua(pdf_lua), items=len(pdf_annotations))
+    stages['get_fingerprint'] = measure(repeat, lambda pdf_context: kohicolib.get_fingerprint(pdf_context), setup=lambda: kohicolib.PdfContext(pdf_path))
+    stages['calculate_page_offsets'] = measure(repeat, lambda pdf_context: kohicolib.calculate_page_offsets(pdf_context), setup=lambda: kohicolib.PdfContext(pdf_path), items=pages)
+    stages[f'text_content_{text_backend}'] = measure(repeat, lambda pdf_context: pdf_context.load_text_contents(page_numbers),
+                                                     setup=lambda: kohicolib.PdfContext(pdf_path, None, text_backend), items=len(page_numbers))
+
+    pdf_context = warm_context(pdf_path, text_backend, page_numbers)
+    stages['find_context'] = measure(repeat, lambda _: [kohicolib.find_context(pdf_context, annotation['page'], annotation['text']) for annotation in pdf_annotations],
+                                     items=len(pdf_annotations))
+    stages['find_string'] = measure(repeat, lambda _: [kohicolib.find_string(pdf_context.text_content(annotation['page']), annotation['text']) for annotation in pdf_annotations],
+                                    items=len(pdf_annotations))
+
+    cfi_data = kohicolib.generate_cfi_map(epub_path)
+    page_count = epub_metadata['stats']['pages']
+    stages['generate_cfi_map'] = measure(repeat, lambda _: kohicolib.generate_cfi_map(epub_path))
+    stages['CFIGenerator'] = measure(repeat, lambda _: kohicolib.CFIGenerator(cfi_data, page_count))
+    bookkey = kohicolib.get_readest_bookkey(epub_path)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = kohicolib.ExtractionCache(cache_dir)
+        kohicolib.load_cfi_map(epub_path, bookkey, cache)
+        stages['load_cfi_map_cached'] = measure(repeat, lambda _: kohicolib.load_cfi_map(epub_path, bookkey, cache))
+        cache.close()
+    stages['build_text_index'] = measure(repeat, lambda _: kohicolib.CFIGenerator(cfi_data, page_count).build_text_index())
+    generator = kohicolib.CFIGenerator(cfi_data, page_count)
+    stages['generate_cfi_range'] = measure(repeat, lambda _: [generator.generate_cfi_range(annotation) for annotation in epub_metadata['annotations']],
+                                           items=len(epub_metadata['annotations']))
+    # Without xpointers, every highlight goes through the text search
+    searched = [dict(annotation, pos0=None, pos1=None) for annotation in epub_metadata['annotations']]
+    stages['generate_cfi_range_search'] = measure(repeat, lambda _: [generator.generate_cfi_range(annotation) for annotation in searched], items=len(searched))
+
+    for output_format in PDF_WRITERS:
+        def prepare(output_format=output_format):
+            remove_outputs(directory)
+            session = kohicolib.KohicoSession(session_args(pdf_path, output_format, text_backend), warm_context(pdf_path, text_backend, page_numbers))
+            with contextlib.redirect_stdout(io.StringIO()):
+                session.prepare()
+            return session
+        writer = kohicolib.OUTPUT_FORMATS[output_format]['writer']
+        stages[writer.__name__] = measure(repeat, writer, setup=prepare, items=len(pdf_annotations))
+    remove_outputs(directory)
+
+    return stages
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPOSITORY, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(baseline, result, threshold):
+    """Prints the change of every stage against a baseline result, returning the stages slower than threshold allows."""
+    regressions = []
+    if baseline['meta'].get('corpus') != result['meta']['corpus']:
+        print(f"Warning: the baseline used a different corpus ({baseline['meta'].get('corpus')}), so times are not comparable.")
+    print(f"{'stage':40} {'baseline':>12} {'current':>12} {'ratio':>8}")
+    for stage, timing in result['stages'].items():
+        before = baseline['stages'].get(stage, {})
+        if 'wall_s' not in timing or 'wall_s' not in before:
+            continue
+        ratio = timing['wall_s'] / before['wall_s'] if before['wall_s'] else float('inf')
+        print(f"{stage:40} {before['wall_s']:12.6f} {timing['wall_s']:12.6f} {ratio:8.2f}")
+        if ratio > threshold:
+            regressions.append(stage)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the stages of a kohico conversion on a synthetic corpus.')
+    parser.add_argument('--pages', type=int, default=100, help='Pages in the synthetic PDF. Default is 100.')
+    parser.add_argument('--highlights', type=int, default=200, help='Highlights per synthetic book. Default is 200.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per stage; the median is reported. Default is 3.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic corpus. Default is 0.')
+    parser.add_argument('--text-backend', choices=['pdfjs', 'pymupdf'], default='pymupdf', help="Source of the pdf.js-style text items. Default is 'pymupdf', which needs no node.")
+    parser.add_argument('--corpus-dir', type=str, default=None, help='Keep the corpus in this directory instead of a temporary one.')
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON result to this path. Default is standard output.')
+    parser.add_argument('--compare', type=str, default=None, help='Baseline JSON result to compare against. Exits with 1 if a stage got slower than --threshold allows.')
+    parser.add_argument('--threshold', type=float, default=1.25, help='Largest allowed ratio of current to baseline time. Default is 1.25.')
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        directory = args.corpus_dir or stack.enter_context(tempfile.TemporaryDirectory())
+        stages = run_benchmarks(os.path.abspath(directory), args.pages, args.highlights, args.repeat, args.text_backend, args.seed)
+
+    result = {
+        'meta': {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'corpus': {'pages': args.pages, 'highlights': args.highlights, 'seed': args.seed},
+            'text_backend': args.text_backend,
+        },
+        'stages': stages,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(json.load(file), result, args.threshold)
+        if regressions:
+            print(f"Slower than {args.threshold}x the baseline: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
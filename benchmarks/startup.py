@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark: times a markdown conversion straight from a metadata.pdf.lua, the lightest kohico run,
+and checks that none of the heavy optional modules get imported along the way. Runs are timed the way users
+start kohico after its first run: with kohicolib's bytecode cached, whatever PYTHONDONTWRITEBYTECODE says.
+
+Usage: python3 benchmarks/startup.py [--runs RUNS] [--budget-ms BUDGET_MS] [--output OUTPUT]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+KOHICO = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'kohico.py')
+
+BUDGET_MS = 60
+
+# Modules a markdown-from-lua run has no use for
+HEAVY_MODULES = ['fitz', 'PyPDF2', 'pdfminer', 'thefuzz', 'fuzzywuzzy', 'sqlite3', 'concurrent.futures']
+
+# Runs kohico as a script, then reports which of the heavy modules ended up loaded
+PROBE = """
+import runpy, sys, json, contextlib, io
+heavy_modules = json.loads(sys.argv[3])
+sys.argv = [sys.argv[1], sys.argv[2], 'md']
+with contextlib.redirect_stdout(io.StringIO()):
+    runpy.run_path(sys.argv[0], run_name='__main__')
+print(json.dumps([name for name in heavy_modules if name in sys.modules]))
+"""
+
+def write_metadata(directory, highlights=50):
+    lua_path = os.path.join(directory, 'metadata.pdf.lua')
+    entries = []
+    for i in range(highlights):
+        entries.append(f'[{i + 1}] = {{ ["chapter"] = "Chapter {i // 10}", ["page"] = {i // 5 + 1}, ["pos0"] = "p{i}", ["pos1"] = "q{i}", ["text"] = "highlight {i}", ["note"] = "note {i}" }}')
+    with open(lua_path, 'w') as file:
+        file.write('return {\n ["annotations"] = {\n' + ',\n'.join(entries) + '\n },\n ["doc_props"] = { ["title"] = "Startup", ["authors"] = "Benchmark" },\n}\n')
+    return lua_path
+
+def time_command(command, runs, env=None):
+    timings = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, env=env)
+        timings.append((time.perf_counter() - start_time) * 1000)
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description="Time kohico's startup on a markdown-from-lua run.")
+    parser.add_argument('--runs', type=int, default=10, help='Number of timed runs. Default is 10.')
+    parser.add_argument('--budget-ms', type=float, default=BUDGET_MS, help=f'Allowed median time on top of a bare interpreter start, in milliseconds. Default is {BUDGET_MS}.')
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON result to this path as well.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        lua_path = write_metadata(directory)
+        env = {name: value for name, value in os.environ.items() if name != 'PYTHONDONTWRITEBYTECODE'}
+        interpreter = time_command([sys.executable, '-c', 'pass'], args.runs, env)
+        # The untimed first run writes the bytecode cache
+        time_command([sys.executable, KOHICO, lua_path, 'md'], 1, env)
+        kohico = time_command([sys.executable, KOHICO, lua_path, 'md'], args.runs, env)
+        probe = subprocess.run([sys.executable, '-c', PROBE, KOHICO, lua_path, json.dumps(HEAVY_MODULES)], check=True, capture_output=True, text=True)
+        heavy_modules = json.loads(probe.stdout.strip().splitlines()[-1])
+
+    overhead = statistics.median(kohico) - statistics.median(interpreter)
+    result = {
+        'python_ms': round(statistics.median(interpreter), 1),
+        'kohico_ms': round(statistics.median(kohico), 1),
+        'kohico_min_ms': round(min(kohico), 1),
+        'overhead_ms': round(overhead, 1),
+        'budget_ms': args.budget_ms,
+        'heavy_modules': heavy_modules,
+        'ok': overhead <= args.budget_ms and not heavy_modules,
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+    sys.exit(0 if result['ok'] else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3015 @@
+#!/usr/bin/env python3
+import sys
+import os
+import re
+import json
+import hashlib
+import string
+from datetime import datetime, timezone
+import argparse
+import time
+import io
+import importlib
+import bisect
+import array
+import contextlib
+import threading
+import atexit
+import select
+import struct
+import mmap
+import posixpath
+import collections
+
+class LazyModule:
+    def __init__(self, name):
+        """
+        Stands in for a module that is imported only when one of its attributes is first used, so that runs
+        which never touch it, such as markdown straight from a metadata.pdf.lua, start without paying for it.
+
+        Args:
+            name: Name of the module, as given to importlib.import_module
+        """
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        value = getattr(self.load(), attribute)
+        setattr(self, attribute, value)  # Later lookups skip __getattr__ entirely
+        return value
+
+fitz = LazyModule('fitz')
+PyPDF2 = LazyModule('PyPDF2')
+fuzz = LazyModule('thefuzz.fuzz')
+lupa = LazyModule('lupa')
+sqlite3 = LazyModule('sqlite3')
+futures = LazyModule('concurrent.futures')
+subprocess = LazyModule('subprocess')
+ctypes = LazyModule('ctypes')
+zipfile = LazyModule('zipfile')
+expat = LazyModule('xml.parsers.expat')
+random = LazyModule('random')
+unicodedata = LazyModule('unicodedata')
+
+DEBUG = False
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Prefix of the /NM name given to every baked highlight, followed by the annotation's ID
+BAKED_ID_PREFIX = 'kohico-'
+CONTAINER_NAMESPACE = 'urn:oasis:names:tc:opendocument:xmlns:container'
+OPF_NAMESPACE = 'http://www.idpf.org/2007/opf'
+XHTML_HTML = 'http://www.w3.org/1999/xhtml html'
+XHTML_BODY = 'http://www.w3.org/1999/xhtml body'
+# A KOReader EPUB position: spine item (from 1), path within its document and an optional character offset
+XPOINTER_PATTERN = re.compile(r'^/body/DocFragment\[(\d+)\]((?:/[^/.]+)+?)(?:\.(\d+))?$')
+
+def generate_readest_uid(length=7):
+    chars = string.ascii_lowercase + string.digits
+    return ''.join(random.choice(chars) for _ in range(length))
+
+class Document:
+    def __init__(self, title, author):
+        self.title = title
+        self.author = author
+
+class ExtractionCache:
+    def __init__(self, cache_dir=None, max_bytes=CACHE_MAX_BYTES):
+        """
+        SQLite store for text extracted from PDFs, so that unchanged documents skip extraction on later runs.
+        Entries are keyed by document fingerprint plus file size and mtime, and whole documents are evicted
+        least recently used first once the cache grows beyond max_bytes. Every write is its own short
+        transaction in WAL mode, so concurrent batch workers, watchers and manual runs never wait on each other
+        for longer than one write.
+
+        Args:
+            cache_dir: Directory holding the cache file, defaults to $XDG_CACHE_HOME/kohico or ~/.cache/kohico
+            max_bytes: Size cap for the cached values
+        """
+        if cache_dir is None:
+            cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'kohico')
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'extraction.sqlite3')
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (doc_key TEXT PRIMARY KEY, path TEXT, last_used REAL);
+            CREATE TABLE IF NOT EXISTS entries (doc_key TEXT, kind TEXT, value TEXT, size INTEGER, PRIMARY KEY (doc_key, kind));
+            CREATE TABLE IF NOT EXISTS fingerprints (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, fingerprint TEXT);
+        """)
+
+    def register(self, doc_key, path):
+        # A new key for a known path means the file changed, so whatever was cached for it is stale.
+        stale_keys = [row[0] for row in self.connection.execute('SELECT doc_key FROM documents WHERE path = ? AND doc_key != ?', (path, doc_key))]
+        with self.connection:
+            for stale_key in stale_keys:
+                self.forget(stale_key)
+            self.connection.execute('INSERT OR REPLACE INTO documents (doc_key, path, last_used) VALUES (?, ?, ?)', (doc_key, path, time.time()))
+
+    def forget(self, doc_key):
+        self.connection.execute('DELETE FROM entries WHERE doc_key = ?', (doc_key,))
+        self.connection.execute('DELETE FROM documents WHERE doc_key = ?', (doc_key,))
+
+    def get(self, doc_key, kind):
+        row = self.connection.execute('SELECT value FROM entries WHERE doc_key = ? AND kind = ?', (doc_key, kind)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, doc_key, kind, value):
+        self.put_many(doc_key, [(kind, value)])
+
+    def put_many(self, doc_key, items):
+        rows = []
+        for kind, value in items:
+            serialized = json.dumps(value)
+            rows.append((doc_key, kind, serialized, len(serialized)))
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO entries (doc_key, kind, value, size) VALUES (?, ?, ?, ?)', rows)
+
+    def get_fingerprint(self, path, size, mtime_ns):
+        row = self.connection.execute('SELECT fingerprint FROM fingerprints WHERE path = ? AND size = ? AND mtime_ns = ?', (path, size, mtime_ns)).fetchone()
+        return row[0] if row is not None else None
+
+    def put_fingerprint(self, path, size, mtime_ns, fingerprint):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO fingerprints (path, size, mtime_ns, fingerprint) VALUES (?, ?, ?, ?)', (path, size, mtime_ns, fingerprint))
+
+    def evict(self):
+        total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        documents = self.connection.execute("""
+            SELECT documents.doc_key, COALESCE(SUM(entries.size), 0) FROM documents
+            LEFT JOIN entries ON entries.doc_key = documents.doc_key
+            GROUP BY documents.doc_key ORDER BY documents.last_used ASC
+        """).fetchall()
+        with self.connection:
+            for doc_key, size in documents:
+                if total <= self.max_bytes:
+                    break
+                self.forget(doc_key)
+                total -= size
+
+    def flush(self):
+        self.evict()
+        self.connection.commit()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+@contextlib.contextmanager
+def atomic_write(path):
+    # Written next to the target and renamed over it, so readers never see a half-written file
+    temporary_path = path + '.tmp'
+    try:
+        with open(temporary_path, 'w') as file:
+            yield file
+        os.replace(temporary_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary_path)
+        raise
+
+def text_digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:10]
+
+class RunState:
+    VERSION = 3
+
+    def __init__(self, path, document_key):
+        """
+        Small JSON sidecar remembering, per stable annotation ID, what was already resolved (context,
+        pdf++ selection) and which annotations each output format has already emitted. Every resolved value
+        is stored with a digest of the text it was searched for, so it is resolved again once that text is
+        edited. Resolved data is dropped when the document changes; emitted IDs are kept, since they describe the outputs.
+
+        Args:
+            path: Path to the state file
+            document_key: Identifies the document version, e.g. its size and mtime
+        """
+        self.path = path
+        self.data = {'version': self.VERSION, 'document': document_key, 'resolved': {}, 'emitted': {}}
+        try:
+            with open(path, 'r') as file:
+                stored = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if stored.get('version') != self.VERSION:
+            return
+        self.data['emitted'] = stored.get('emitted', {})
+        if stored.get('document') == document_key:
+            self.data['resolved'] = stored.get('resolved', {})
+
+    def resolved(self, annotation_id, kind, searched):
+        entry = self.data['resolved'].get(annotation_id, {}).get(kind)
+        if entry is None or entry['searched'] != text_digest(searched):
+            return None
+        return entry['value']
+
+    def set_resolved(self, annotation_id, kind, value, searched):
+        self.data['resolved'].setdefault(annotation_id, {})[kind] = {'value': value, 'searched': text_digest(searched)}
+
+    def emitted(self, output_format):
+        return set(self.data['emitted'].get(output_format, []))
+
+    def mark_emitted(self, output_format, annotation_ids):
+        self.data['emitted'][output_format] = sorted(self.emitted(output_format) | set(annotation_ids))
+
+    def forget_emitted(self, output_format):
+        self.data['emitted'].pop(output_format, None)
+
+    def prune(self, annotation_ids):
+        # Highlights deleted in KOReader should not linger in the state
+        self.data['resolved'] = {key: value for key, value in self.data['resolved'].items() if key in annotation_ids}
+
+    def save(self):
+        with atomic_write(self.path) as file:
+            json.dump(self.data, file)
+
+def new_match_stats():
+    return {'windows': 0, 'score': None, 'seconds': 0.0}
+
+class Profiler:
+    def __init__(self, report_path=None, cprofile_path=None, trace_memory=False):
+        """
+        Collects the --profile data of one conversion: wall time and CPU time per pipeline stage, peak traced memory
+        too with --trace-memory, and for every highlight the time spent matching it, the candidate windows tried and
+        the final fuzzy score. Without a report path, stages and matches are not recorded and cost nothing.
+
+        Args:
+            report_path: Where to write the JSON report
+            cprofile_path: Where to dump cProfile statistics, readable with pstats
+            trace_memory: Whether to trace allocations for peak memory, which slows every stage down
+        """
+        self.report_path = report_path
+        self.cprofile_path = cprofile_path
+        self.trace_memory = trace_memory and report_path is not None
+        self.cprofile = None
+        self.stages = []
+        self.open_stages = []
+        self.matches = []
+        self.annotation_count = None
+        self.start_wall = None
+        self.start_cpu = None
+
+    def start(self):
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+        if self.report_path is not None:
+            self.start_wall = time.perf_counter()
+            self.start_cpu = time.process_time()
+        if self.cprofile_path is not None:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def fold_peak(self):
+        # tracemalloc keeps a single peak, so it is credited to every open stage before being reset
+        if not self.trace_memory:
+            return
+        import tracemalloc
+        peak = tracemalloc.get_traced_memory()[1]
+        for record in self.open_stages:
+            record['peak_traced_bytes'] = max(record['peak_traced_bytes'], peak)
+        tracemalloc.reset_peak()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.report_path is None:
+            yield
+            return
+        self.fold_peak()
+        record = {'stage': name, 'depth': len(self.open_stages), 'start_s': round(time.perf_counter() - self.start_wall, 6)}
+        if self.trace_memory:
+            record['peak_traced_bytes'] = 0
+        self.open_stages.append(record)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            record['wall_s'] = round(time.perf_counter() - wall_start, 6)
+            record['cpu_s'] = round(time.process_time() - cpu_start, 6)
+            self.fold_peak()
+            self.open_stages.pop()
+            self.stages.append(record)
+
+    @contextlib.contextmanager
+    def match(self, annotation, kind):
+        if self.report_path is None:
+            yield None
+            return
+        stats = new_match_stats()
+        start_time = time.perf_counter()
+        yield stats
+        stats['seconds'] = time.perf_counter() - start_time
+        self.record_match(annotation, kind, stats)
+
+    def record_match(self, annotation, kind, stats, page_number=None, text=None):
+        if self.report_path is None:
+            return
+        self.matches.append({
+            'id': annotation.unique_id if annotation is not None else None,
+            'page': annotation.page_number if annotation is not None else page_number,
+            'kind': kind,
+            'seconds': round(stats['seconds'], 6),
+            'windows': stats['windows'],
+            'score': stats['score'],
+            'text': (annotation.highlight if annotation is not None else text)[:80],
+        })
+
+    def stop(self, session):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_path)
+            print(f"cProfile statistics saved as {self.cprofile_path}.")
+        if self.report_path is None:
+            return
+        self.fold_peak()
+        try:
+            import resource
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        except ImportError:
+            max_rss = None
+        report = {
+            'file_path': session.file_path,
+            'output_format': session.args.output_format,
+            'annotations': self.annotation_count,
+            'wall_s': round(time.perf_counter() - self.start_wall, 6),
+            'cpu_s': round(time.process_time() - self.start_cpu, 6),
+            'peak_traced_bytes': max((stage['peak_traced_bytes'] for stage in self.stages), default=0) if self.trace_memory else None,
+            'max_rss': max_rss,  # Kilobytes on Linux, bytes on macOS
+            'stages': sorted(self.stages, key=lambda stage: (stage['start_s'], stage['depth'])),
+            'slowest': sorted(self.matches, key=lambda match: -match['seconds'])[:10],
+            'matches': self.matches,
+        }
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.stop()
+        with atomic_write(self.report_path) as file:
+            json.dump(report, file, indent=2)
+        print(f"Profile saved as {self.report_path}.")
+
+def annotation_id(page, pos0, pos1, text):
+    """Stable ID for a KOReader highlight, derived from where it is and what it says."""
+    key = json.dumps([page, pos0, pos1, text], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:10]
+
+class PdfContext:
+    def __init__(self, path, cache=None, text_backend='pdfjs'):
+        """
+        Holds a PDF that is opened once per run and shared by fingerprinting, context lookup, pdf++ offset resolution and baking.
+        Everything is loaded lazily and memoized, so stages that are not needed cost nothing. The documents are opened
+        from the file, never copied into memory whole, as scanned books can run to hundreds of megabytes.
+
+        Args:
+            path: Path to the PDF file
+            cache: Optional ExtractionCache, consulted before extracting any text
+            text_backend: 'pdfjs' or 'pymupdf', the source of the pdf.js-style text items used for pdf++ selections
+        """
+        self.path = path
+        self.cache = cache
+        self.text_backend = text_backend
+        self._file = None
+        self._reader = None
+        self._fitz_doc = None
+        self._fingerprint = None
+        self._cache_key = None
+        self._page_texts = {}
+        self._page_offsets = None
+        self._text_contents = {}
+
+    def head(self, size):
+        with open(self.path, 'rb') as file:
+            return file.read(size)
+
+    @property
+    def reader(self):
+        if self._reader is None:
+            # Given a path, PyPDF2 reads the whole file into memory; given an open file, it seeks to what it needs
+            self._file = open(self.path, 'rb')
+            self._reader = PyPDF2.PdfReader(self._file)
+        return self._reader
+
+    @property
+    def fitz_doc(self):
+        if self._fitz_doc is None:
+            self._fitz_doc = fitz.open(self.path, filetype="pdf")
+        return self._fitz_doc
+
+    def release_fitz_doc(self):
+        # Baking adds annotations to the document, so later users must get a fresh one
+        if self._fitz_doc is not None:
+            self._fitz_doc.close()
+            self._fitz_doc = None
+
+    def close(self):
+        # Closes the opened documents; extracted text stays, so a reused context only reopens them on demand
+        self.release_fitz_doc()
+        self._reader = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            if self.cache is None:
+                self._fingerprint = get_fingerprint(self)
+            else:
+                # An unchanged file keeps its fingerprint, so batch and watch runs read it only once
+                stat = os.stat(self.path)
+                key = (os.path.abspath(self.path), stat.st_size, stat.st_mtime_ns)
+                self._fingerprint = self.cache.get_fingerprint(*key)
+                if self._fingerprint is None:
+                    self._fingerprint = get_fingerprint(self)
+                    self.cache.put_fingerprint(*key, self._fingerprint)
+        return self._fingerprint
+
+    @property
+    def cache_key(self):
+        if self._cache_key is None:
+            stat = os.stat(self.path)
+            self._cache_key = f"{self.fingerprint}:{stat.st_size}:{stat.st_mtime_ns}"
+            self.cache.register(self._cache_key, os.path.abspath(self.path))
+        return self._cache_key
+
+    def cached(self, kind, compute):
+        if self.cache is None:
+            return compute()
+        value = self.cache.get(self.cache_key, kind)
+        if value is None:
+            value = compute()
+            self.cache.put(self.cache_key, kind, value)
+        return value
+
+    @property
+    def page_count(self):
+        if self._page_offsets is not None:
+            return len(self._page_offsets) - 1
+        return len(self.reader.pages)
+
+    def page_text(self, page_number):
+        if page_number not in self._page_texts:
+            self._page_texts[page_number] = self.cached(f"text:{page_number}", lambda: self.reader.pages[page_number - 1].extract_text())
+        return self._page_texts[page_number]
+
+    @property
+    def page_offsets(self):
+        if self._page_offsets is None:
+            self._page_offsets = self.cached("page_offsets", lambda: calculate_page_offsets(self))
+        return self._page_offsets
+
+    def load_text_contents(self, page_numbers):
+        """Fetch pdf.js text content for the given pages that are not loaded yet, in one request."""
+        missing = sorted({page_number for page_number in page_numbers if page_number not in self._text_contents})
+        if self.cache is not None:
+            for page_number in list(missing):
+                cached_page = self.cache.get(self.cache_key, f"{self.text_backend}:{page_number}")
+                if cached_page is not None:
+                    self._text_contents[page_number] = cached_page
+                    missing.remove(page_number)
+        if not missing:
+            return
+        if self.text_backend == 'pymupdf':
+            pages = get_pymupdf_text_content(self, missing)
+        else:
+            pages = get_pdfjs_text_content(self.path, missing)
+        for page in pages:
+            self._text_contents[page['page']] = page
+        if self.cache is not None:
+            self.cache.put_many(self.cache_key, [(f"{self.text_backend}:{page['page']}", page) for page in pages])
+
+    def text_content(self, page_number):
+        self.load_text_contents([page_number])
+        return self._text_contents.get(page_number)
+
+class Annotation:
+    def __init__(self, fingerprint, title, vault_path, text, notes, pdf_context, page_number, context, chapter, author=None, raw_vault_path=None, unique_id=None, highlight=None):
+        if unique_id is None:
+            characters = string.ascii_lowercase + string.digits
+            unique_id = ''.join(random.choice(characters) for _ in range(10))
+        self.unique_id = unique_id
+        self.pdf_context = pdf_context
+        self.fingerprint = fingerprint
+        self.vault_path = vault_path
+        self.raw_vault_path = raw_vault_path
+        self.author = author
+        self.title = title
+        self.notes = notes
+        self.text = text
+        # The highlighted passage itself: 'text' in KOReader's annotations, but 'notes' in its older bookmarks
+        self.highlight = text if highlight is None else highlight
+        self.page_number = page_number
+        self.chapter = chapter
+        # Anchors are resolved once and shared by every output format: context (global offsets, prefix
+        # and suffix), selection (pdf.js item offsets) and rects (page rectangles)
+        self.context = context
+        self.selection = None
+        self.rects = None
+        self.resolved = set() if context is None else {'context'}
+        self.created = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-4]+"7Z"
+
+    @property
+    def data(self):
+        return {
+                "text": self.text,
+                "created": self.created,
+                "updated": self.created,
+                "document": {
+                    "title": self.title ,
+                    "link": [
+                        {"href": "urn:x-pdf:"+self.fingerprint},
+                        {"href": self.vault_path}
+                        ],
+                    "documentFingerprint": self.fingerprint
+                    },
+                "uri": self.vault_path,
+                "target": [
+                    {
+                        "source": self.vault_path,
+                        "selector": [
+                            {
+                                "type": "TextPositionSelector",
+                                "start": self.context['start_pos'],
+                                "end": self.context['end_pos'] 
+                                },
+                            {
+                                "type": "TextQuoteSelector",
+                                "exact": self.notes,
+                                "prefix": self.context['preceding'],
+                                "suffix": self.context['succeeding'] 
+                                }
+                            ]
+                        }
+                    ]
+                }
+
+    def set_context(self, context):
+        self.context = context
+        self.resolved.add('context')
+
+    def set_selection(self, selection):
+        self.selection = selection
+        self.resolved.add('selection')
+
+    def get_context(self, stats=None):
+        if 'context' not in self.resolved:
+            self.set_context(find_context(self.pdf_context, self.page_number, self.notes, stats))
+        return self.context
+
+    def hypothesis_data(self):
+        return json.dumps(self.data)
+
+    def nonewlines(self, string):
+        return string.replace('\r\n', '').replace('\n', '')
+
+    def get_selection_offsets(self, stats=None):
+        if 'selection' not in self.resolved:
+            text_contents = self.pdf_context.text_content(self.page_number)
+            self.set_selection(selection_from_match(find_string(text_contents, self.text, stats)))
+        return self.selection
+
+    def set_rects(self, rects):
+        self.rects = rects
+        self.resolved.add('rects')
+
+
+    def pdfplus(self):
+        selection = self.get_selection_offsets()
+        return_string = f"""> [!PDF|] [[{self.raw_vault_path}#page={self.page_number}&selection={selection['id']},{selection['start']},{selection['end_id']},{selection['end']}|Hanley2004, p. ({self.page_number})]]
+> > {self.text}
+> 
+> {self.notes}
+
+        """
+        return return_string + '\n'
+
+    def hypothesis(self):
+        return_string = f"""
+>%%
+>```annotation-json
+>{self.hypothesis_data()}
+>```
+>%%
+>*%%PREFIX%%{self.nonewlines(self.context['preceding'])}%%HIGHLIGHT%% =={self.nonewlines(self.notes)}== %%POSTFIX%%{self.nonewlines(self.context['succeeding'])}*
+>%%LINK%%[[#^{self.unique_id}|show annotation]]
+>%%COMMENT%%
+>{self.nonewlines(self.text)}
+>%%TAGS%%
+>
+^{self.unique_id}"""
+        return return_string + '\n'
+
+
+
+    def markdown(self, annotation_template, iteration):
+        # Only the values the compiled template actually uses are computed
+        fields = {
+            'text': lambda: self.notes,
+            'page_number': lambda: self.page_number,
+            'highlight': lambda: self.text,
+            'context': lambda: self.context,
+            'unique_id': lambda: self.unique_id,
+            'data': lambda: self.data,
+            'iteration': lambda: iteration,
+            'title': lambda: self.title,
+            'author': lambda: self.author,
+            'vault_path': lambda: self.vault_path,
+            'chapter': lambda: self.chapter,
+        }
+        values = {name: fields[name]() for name in annotation_template.fields if name in fields}
+        return annotation_template.render(values)
+
+
+class CfiMap:
+    VERSION = 3
+
+    def __init__(self, full_text, spines, offsets, lengths, spine_indices, paths, path_indices, xpointers, xpointer_indices):
+        """
+        The CFI map of a book (see generate_cfi_map) in columnar form. Instead of one dict per text node, the offsets,
+        lengths, spines and CFI paths of all nodes are kept in parallel arrays, with the paths (the part of a CFI
+        after the '!') interned. Node texts are slices of full_text, and node dicts are only built for the nodes a
+        highlight lands on.
+
+        Args:
+            full_text: The text of all nodes, concatenated
+            spines: Dicts with the idref, href and spine CFI (the part of a CFI before the '!') of every spine item
+            offsets: Offset of every node, counted from 1 as in generate_cfi_map
+            lengths: Length of every node
+            spine_indices: Index into spines of every node
+            paths: The distinct CFI paths
+            path_indices: Index into paths of every node
+            xpointers: The distinct KOReader xpointer paths (see parse_xpointer), or None for nodes without one
+            xpointer_indices: Index into xpointers of every node
+        """
+        self.full_text = full_text
+        self.spines = spines
+        self.offsets = offsets
+        self.lengths = lengths
+        self.spine_indices = spine_indices
+        self.paths = paths
+        self.path_indices = path_indices
+        self.xpointers = xpointers
+        self.xpointer_indices = xpointer_indices
+        self._xpointer_nodes = None
+
+    @classmethod
+    def from_dict(cls, data):
+        spines = []
+        offsets = array.array('q')
+        lengths = array.array('q')
+        spine_indices = array.array('l')
+        paths = []
+        path_indices = array.array('l')
+        path_ids = {}
+        xpointers = []
+        xpointer_indices = array.array('l')
+        xpointer_ids = {}
+        for spine_index, spine in enumerate(data['spines']):
+            spine_cfi = None
+            for item in spine.get('content', []):
+                spine_cfi, path = item['cfi'].split('!', 1)
+                if path not in path_ids:
+                    path_ids[path] = len(paths)
+                    paths.append(path)
+                xpointer = item.get('xpointer')
+                if xpointer not in xpointer_ids:
+                    xpointer_ids[xpointer] = len(xpointers)
+                    xpointers.append(xpointer)
+                offsets.append(item['offset'])
+                lengths.append(item['length'])
+                spine_indices.append(spine_index)
+                path_indices.append(path_ids[path])
+                xpointer_indices.append(xpointer_ids[xpointer])
+            spines.append({'idref': spine['idref'], 'href': spine['href'], 'cfi': spine_cfi})
+        return cls(data['full_text'], spines, offsets, lengths, spine_indices, paths, path_indices, xpointers, xpointer_indices)
+
+    @classmethod
+    def from_cache(cls, value):
+        return cls(value['full_text'], value['spines'], array.array('q', value['offsets']), array.array('q', value['lengths']),
+                   array.array('l', value['spine_indices']), value['paths'], array.array('l', value['path_indices']),
+                   value['xpointers'], array.array('l', value['xpointer_indices']))
+
+    def to_cache(self):
+        return {
+            'version': self.VERSION,
+            'full_text': self.full_text,
+            'spines': self.spines,
+            'offsets': self.offsets.tolist(),
+            'lengths': self.lengths.tolist(),
+            'spine_indices': self.spine_indices.tolist(),
+            'paths': self.paths,
+            'path_indices': self.path_indices.tolist(),
+            'xpointers': self.xpointers,
+            'xpointer_indices': self.xpointer_indices.tolist(),
+        }
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def node(self, index):
+        spine = self.spines[self.spine_indices[index]]
+        offset = self.offsets[index]
+        return {
+            "node": self.full_text[offset - 1:offset - 1 + self.lengths[index]],
+            "cfi": f"{spine['cfi']}!{self.paths[self.path_indices[index]]}",
+            "href": spine["href"],
+            "offset": offset,
+            "idref": spine["idref"]
+        }
+
+    def node_text(self, index):
+        # The node text as in the document, undoing the escaping of generate_cfi_map
+        offset = self.offsets[index]
+        return self.full_text[offset - 1:offset - 1 + self.lengths[index]].replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
+
+    def raw_offset(self, index, offset):
+        # Offsets into full_text count the escaped node text, CFI offsets the text as in the document
+        start = self.offsets[index] - 1
+        return len(self.full_text[start:start + offset].replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&'))
+
+    def find_xpointer(self, spine_index, xpointer):
+        """Returns the index of the node at an xpointer path in a spine item, or None."""
+        if self._xpointer_nodes is None:
+            self._xpointer_nodes = {}
+            for index in range(len(self)):
+                xpointer_path = self.xpointers[self.xpointer_indices[index]]
+                if xpointer_path is not None:
+                    self._xpointer_nodes[(self.spine_indices[index], xpointer_path)] = index
+        return self._xpointer_nodes.get((spine_index, xpointer))
+
+def parse_xpointer(xpointer):
+    """
+    Splits a KOReader xpointer such as /body/DocFragment[12]/body/div/p[4]/text().17 into the spine index, the
+    path within the spine document with every step indexed (/body[1]/div[1]/p[4]/text()[1]) and the character offset.
+    Returns None for anything else.
+    """
+    match = XPOINTER_PATTERN.match(xpointer) if isinstance(xpointer, str) else None
+    if match is None:
+        return None
+    steps = []
+    for step in match.group(2).strip('/').split('/'):
+        name, _, index = step.partition('[')
+        steps.append(f"{name.lower()}[{index.rstrip(']') or 1}]")
+    return int(match.group(1)) - 1, '/' + '/'.join(steps), int(match.group(3) or 0)
+
+def collapsed_to_raw_offset(text, offset, keep_leading_space):
+    """
+    crengine counts xpointer offsets in a text node as it lays the text out: every run of whitespace collapsed to
+    one space, and leading whitespace dropped where the node starts a block. Returns the offset into the raw node
+    text that such an offset points at, or None if it lies past the end of the node.
+    """
+    whitespace = ' \t\r\n'
+    index = 0
+    if not keep_leading_space:
+        while index < len(text) and text[index] in whitespace:
+            index += 1
+    for _ in range(offset):
+        if index >= len(text):
+            return None
+        if text[index] in whitespace:
+            while index < len(text) and text[index] in whitespace:
+                index += 1
+        else:
+            index += 1
+    return index
+
+def within_edit_distance(a, b, limit):
+    # Levenshtein distance of at most limit, computed only in the band of diagonals it allows
+    if abs(len(a) - len(b)) > limit:
+        return False
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        low = max(1, i - limit)
+        high = min(len(b), i + limit)
+        current = [limit + 1] * (len(b) + 1)
+        if i <= limit:
+            current[0] = i
+        for j in range(low, high + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+        if min(current[low - 1:high + 1]) > limit:
+            return False
+        previous = current
+    return previous[len(b)] <= limit
+
+def same_highlight(selected, highlight):
+    """
+    Whether the text between two xpointers is the highlighted text. Whitespace and soft hyphens are ignored and
+    ligatures expanded. Beyond that both ends must line up exactly, so that a range shifted by even one character
+    is rejected, and in between only a few edits are allowed, for a book edited since the highlight was made.
+    """
+    selected, highlight = (''.join(unicodedata.normalize('NFKC', text).replace('\u00ad', '').split()) for text in (selected, highlight))
+    if selected == highlight:
+        return True
+    return selected[:3] == highlight[:3] and selected[-3:] == highlight[-3:] and within_edit_distance(selected, highlight, max(2, len(highlight) // 20))
+
+def load_cfi_map(epub_path, bookkey, cache=None, jobs=1):
+    """
+    Returns the CfiMap of an EPUB, from the extraction cache if it holds one for the Readest book key, otherwise
+    generated and then cached.
+
+    Args:
+        epub_path: Path to the EPUB file
+        bookkey: The book's Readest key, a hash of its contents
+        cache: Optional ExtractionCache
+        jobs: Number of worker processes for generate_cfi_map
+    """
+    if cache is None:
+        return CfiMap.from_dict(generate_cfi_map(epub_path, jobs))
+    doc_key = f"readest:{bookkey}"
+    cache.register(doc_key, os.path.abspath(epub_path))
+    value = cache.get(doc_key, 'cfi_map')
+    if value is not None and value.get('version') == CfiMap.VERSION:
+        return CfiMap.from_cache(value)
+    cfi_map = CfiMap.from_dict(generate_cfi_map(epub_path, jobs))
+    cache.put(doc_key, 'cfi_map', cfi_map.to_cache())
+    return cfi_map
+
+class CFIGenerator:
+    INDEX_GRAM_SIZE = 8
+    INDEX_STRIDE = 4
+    INDEX_MAX_OCCURRENCES = 64
+    INDEX_MAX_CANDIDATES = 5
+
+    def __init__(self, cfi_map, page_count):
+        """
+        Initialize with the complete CFI data structure
+
+        Args:
+            cfi_map: A CfiMap, or the generate_cfi_map dict (full_text plus spines with idref, href, and content arrays) to build one from
+        """
+        if not isinstance(cfi_map, CfiMap):
+            cfi_map = CfiMap.from_dict(cfi_map)
+        self.cfi_map = cfi_map
+        self.page_count = page_count
+
+        # Flat interval index over every content node, sorted by start offset, so that overlap lookups
+        # are a bisect plus a short forward walk instead of a scan over the whole book
+        offsets = cfi_map.offsets
+        lengths = cfi_map.lengths
+        self.node_indices = sorted(range(len(cfi_map)), key=offsets.__getitem__)
+        # Map offsets count from 1, match positions in full_text from 0
+        self.node_starts = [offsets[index] - 1 for index in self.node_indices]
+        self.node_ends = [offsets[index] - 1 + lengths[index] for index in self.node_indices]
+        # Running maximum of node ends, so the walk can start at the first node that could still overlap
+        self.node_max_ends = []
+        max_end = None
+        for node_end in self.node_ends:
+            max_end = node_end if max_end is None else max(max_end, node_end)
+            self.node_max_ends.append(max_end)
+
+        # Built by find_indexed_match on the first highlight whose xpointers do not resolve
+        self.text_index = None
+
+    def build_text_index(self):
+        """
+        Build an inverted index from hashed character n-grams to positions in a normalized (lowercased,
+        whitespace-collapsed) copy of full_text. Only every INDEX_STRIDE-th position is indexed; a match
+        still shares every INDEX_STRIDE-th n-gram of the highlight with the book, which is plenty of votes.
+        """
+        full_text = self.cfi_map.full_text
+        words = []
+        raw_positions = array.array('q')
+        for word_match in re.finditer(r'\S+', full_text):
+            if words:
+                raw_positions.append(word_match.start() - 1)
+            words.append(word_match.group(0))
+            raw_positions.extend(range(word_match.start(), word_match.end()))
+        normalized_text = ' '.join(words)
+        if len(normalized_text.lower()) == len(normalized_text):
+            normalized_text = normalized_text.lower()
+
+        index = {}
+        for i in range(0, len(normalized_text) - self.INDEX_GRAM_SIZE + 1, self.INDEX_STRIDE):
+            index.setdefault(hash(normalized_text[i:i + self.INDEX_GRAM_SIZE]), []).append(i)
+
+        self.normalized_text = normalized_text
+        self.raw_positions = raw_positions
+        self.text_index = index
+
+    def find_indexed_match(self, annotation_text, page):
+        """
+        Locate annotation_text in full_text by letting its n-grams vote for a start position in the index.
+        The few best supported candidates are fuzzy-verified; the best score wins, and the page estimate breaks ties
+        between repeated passages.
+
+        Returns (match_start, match_end) as full_text offsets, or (None, None).
+        """
+        # Ligatures expanded, as the book text spells them out
+        needle = ' '.join(unicodedata.normalize('NFKC', annotation_text).split()).lower()
+        gram_size = self.INDEX_GRAM_SIZE
+        # Shorter needles might not cover a single indexed position
+        if len(needle) < gram_size + self.INDEX_STRIDE - 1:
+            return None, None
+        if self.text_index is None:
+            self.build_text_index()
+
+        votes = {}
+        for j in range(len(needle) - gram_size + 1):
+            positions = self.text_index.get(hash(needle[j:j + gram_size]))
+            if positions and len(positions) <= self.INDEX_MAX_OCCURRENCES:
+                for position in positions:
+                    votes[position - j] = votes.get(position - j, 0) + 1
+
+        candidates = []
+        for start in sorted(votes, key=lambda start: (-votes[start], start)):
+            if any(abs(start - other) < len(needle) // 2 for other in candidates):
+                continue
+            candidates.append(start)
+            if len(candidates) == self.INDEX_MAX_CANDIDATES:
+                break
+
+        estimate = (page / self.page_count) * len(self.normalized_text)
+        verified = []
+        for start in candidates:
+            start = max(0, start)
+            score = fuzz.ratio(needle, self.normalized_text[start:start + len(needle)])
+            if score > 80:
+                verified.append((-score, abs(start - estimate), start))
+
+        if not verified:
+            return None, None
+        best_start = min(verified)[2]
+        end = min(best_start + len(needle), len(self.normalized_text)) - 1
+        return self.raw_positions[best_start], self.raw_positions[end] + 1
+
+
+    def find_nodes_for_match(self, start, end):
+        """Returns the indices of the nodes overlapping full_text[start:end], in document order."""
+        if DEBUG:
+            print(start, end)
+        found = []
+        index = bisect.bisect_right(self.node_max_ends, start)
+        while index < len(self.node_starts) and self.node_starts[index] < end:
+            # Check for overlap between matched text and node
+            if start < self.node_ends[index]:
+                found.append(self.node_indices[index])
+            index += 1
+
+        # Nodes are stored spine by spine in document order, so their indices sort the same way
+        return sorted(found)
+
+    def locate_xpointer(self, xpointer):
+        parsed = parse_xpointer(xpointer)
+        if parsed is None:
+            return None
+        spine_index, xpointer_path, offset = parsed
+        node_index = self.cfi_map.find_xpointer(spine_index, xpointer_path)
+        if node_index is None:
+            return None
+        return node_index, offset
+
+    def xpointer_cfi_range(self, annotation):
+        """
+        Translates the pos0 and pos1 xpointers KOReader stores for a highlight straight into a CFI range, without
+        searching for the text. Returns None when they do not resolve to nodes of one spine document, or when the
+        text between them is not the highlighted text, so that the search can take over.
+        """
+        start = self.locate_xpointer(annotation.get('pos0'))
+        end = self.locate_xpointer(annotation.get('pos1'))
+        if start is None or end is None:
+            return None
+        (start_index, collapsed_start), (end_index, collapsed_end) = start, end
+        cfi_map = self.cfi_map
+        if cfi_map.spine_indices[start_index] != cfi_map.spine_indices[end_index] or start_index > end_index:
+            return None
+
+        # Whether crengine dropped a node's leading whitespace depends on the layout, which the map does not know,
+        # so both readings are tried and only one that selects exactly the highlighted text is taken
+        start_text = cfi_map.node_text(start_index)
+        end_text = cfi_map.node_text(end_index)
+        for keep_start_space, keep_end_space in ((False, False), (True, True), (False, True), (True, False)):
+            if start_index == end_index and keep_start_space != keep_end_space:
+                continue
+            start_offset = collapsed_to_raw_offset(start_text, collapsed_start, keep_start_space)
+            end_offset = collapsed_to_raw_offset(end_text, collapsed_end, keep_end_space)
+            if start_offset is None or end_offset is None or (start_index, start_offset) > (end_index, end_offset):
+                continue
+            # Nodes of a spine document are stored consecutively, so the selection covers the nodes in between
+            if start_index == end_index:
+                selected = start_text[start_offset:end_offset]
+            else:
+                selected = ''.join([start_text[start_offset:]]
+                                   + [cfi_map.node_text(index) for index in range(start_index + 1, end_index)]
+                                   + [end_text[:end_offset]])
+            if same_highlight(selected, annotation['text']):
+                break
+        else:
+            return None
+        return self.cfi_range(start_index, start_offset, end_index, end_offset)
+
+    def cfi_range(self, start_index, start_offset, end_index, end_offset):
+        """
+        Builds the CFI range from a character offset into one node to one into another node of the same spine
+        document, from the step paths in the map.
+        """
+        cfi_map = self.cfi_map
+        # The steps both ends share become the parent of the range, the rest its start and end
+        start_steps = cfi_map.paths[cfi_map.path_indices[start_index]].rsplit(':', 1)[0].split('/')[1:]
+        end_steps = cfi_map.paths[cfi_map.path_indices[end_index]].rsplit(':', 1)[0].split('/')[1:]
+        shared = 0
+        while shared < min(len(start_steps), len(end_steps)) - 1 and start_steps[shared] == end_steps[shared]:
+            shared += 1
+        parent = ''.join(f"/{step}" for step in start_steps[:shared])
+        start_position = ''.join(f"/{step}" for step in start_steps[shared:])
+        end_position = ''.join(f"/{step}" for step in end_steps[shared:])
+        spine_cfi = cfi_map.spines[cfi_map.spine_indices[start_index]]['cfi']
+        return f"epubcfi({spine_cfi}!{parent},{start_position}:{start_offset},{end_position}:{end_offset})"
+
+    def generate_cfi_range(self, annotation):
+        if DEBUG:
+            print(f"Looking for: {annotation['text']}")
+        # KOReader's own positions are exact, so the search below is only a fallback
+        cfi = self.xpointer_cfi_range(annotation)
+        if cfi is not None:
+            return cfi
+        page = annotation['pageno']
+        annotation_text = annotation['text']
+        text_len = len(annotation_text)
+        full_text = self.cfi_map.full_text  # Move this outside the loop
+        text_length = len(full_text)
+
+        # Precompute these once
+        page_percentage = (page / self.page_count) * 100
+        values = [0.05, 0.15, 0.3, 0.6, 0.9, 1.0]
+
+        # Exact-ish lookup through the n-gram index first, the widening windows only if that fails
+        match_start, match_end = self.find_indexed_match(annotation_text, page)
+
+        if match_start is None:
+            for percentage in values:
+                # Calculate ranges
+                start_percentage = max(0, ((page - (self.page_count * percentage)) / self.page_count) * 100)
+                end_percentage = min(100, ((page + (self.page_count * percentage)) / self.page_count) * 100)
+
+                # Convert to character offsets
+                start_char = int((start_percentage / 100) * text_length)
+                end_char = int((end_percentage / 100) * text_length)
+
+                # Extract substring
+                extracted_text = full_text[start_char:end_char]
+
+                # Optimized fuzzy search
+                best_match_pos = None
+                highest_score = 0
+
+                # Slide through the extracted text with a larger step to reduce iterations
+                step = max(1, len(annotation_text) // 4)  # Adjust step size as needed
+                for i in range(0, len(extracted_text) - text_len + 1, step):
+                    candidate = extracted_text[i:i + text_len]
+                    score = fuzz.partial_ratio(annotation_text, candidate)
+                    if score > highest_score:
+                        highest_score = score
+                        best_match_pos = i
+                        if highest_score > 90:  # Early exit if we find a very good match
+                            break
+
+                if highest_score > 80:
+                    match_start = start_char + best_match_pos
+                    match_end = match_start + text_len
+                    break
+
+        if match_start is None:
+            # Fallback to full text search if nothing found in ranges
+            best_match_pos = None
+            highest_score = 0
+            for i in range(0, len(full_text) - text_len + 1, text_len // 2):
+                candidate = full_text[i:i + text_len]
+                score = fuzz.partial_ratio(annotation_text, candidate)
+                if score > highest_score:
+                    highest_score = score
+                    best_match_pos = i
+                    if highest_score > 90:
+                        break
+
+            if highest_score > 80:
+                match_start = best_match_pos + 3
+                match_end = match_start + text_len
+
+        if DEBUG:
+            print(f"Match start: {match_start}, Match end: {match_end}")
+
+        if match_start is None:
+            return None
+        return self.match_cfi_range(match_start, match_end)
+
+    def match_cfi_range(self, match_start, match_end):
+        """Builds the CFI range of full_text[match_start:match_end], or None if it covers no node."""
+        cfi_map = self.cfi_map
+        node_indices = self.find_nodes_for_match(match_start, match_end)
+        if not node_indices:
+            return None
+        start_index, end_index = node_indices[0], node_indices[-1]
+        if cfi_map.spine_indices[start_index] != cfi_map.spine_indices[end_index]:
+            raise ValueError("Annotation spans multiple content documents")
+        start_offset = cfi_map.raw_offset(start_index, max(0, match_start - (cfi_map.offsets[start_index] - 1)))
+        end_offset = cfi_map.raw_offset(end_index, min(cfi_map.lengths[end_index], match_end - (cfi_map.offsets[end_index] - 1)))
+        return self.cfi_range(start_index, start_offset, end_index, end_offset)
+
+
+def get_readest_bookkey(file_path):
+    # Readest's partial MD5: 1 KB from the start and 1 KB at each of 1 KB, 4 KB, 16 KB, ... up to 1 GB
+    hasher = hashlib.md5()
+    file_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as file:
+        for i in range(-1, 11):
+            start = 0 if i < 0 else 1024 << (2 * i)
+            if start >= file_size:
+                break
+            file.seek(start)
+            hasher.update(file.read(1024))
+    return hasher.hexdigest()
+
+
+def xml_local_name(name):
+    # Expat reports namespaced names as 'namespace local-name'
+    return name.rsplit(' ', 1)[-1]
+
+def new_xml_parser():
+    parser = expat.ParserCreate(namespace_separator=' ')
+    parser.buffer_text = True
+    # Without their DTD, entities like &nbsp; are undefined; keep them as literal text, as xmldom does, instead of failing
+    parser.UseForeignDTD(True)
+    return parser
+
+def parse_xml_elements(file):
+    """Parses a small XML file, such as container.xml or the package document, into nested element dicts with name, attributes, children and parent."""
+    document = {'name': '', 'attributes': {}, 'children': [], 'parent': None}
+    stack = [document]
+
+    def start_element(name, attributes):
+        element = {'name': name, 'attributes': attributes, 'children': [], 'parent': stack[-1]}
+        stack[-1]['children'].append(element)
+        stack.append(element)
+
+    parser = new_xml_parser()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = lambda name: stack.pop()
+    parser.ParseFile(file)
+    return document['children'][0]
+
+def iter_xml_elements(element, name):
+    # Depth first, in document order, like the // axis
+    pending = [element]
+    while pending:
+        element = pending.pop()
+        if element['name'] == name:
+            yield element
+        pending.extend(reversed(element['children']))
+
+def cfi_element_steps(element, top_level_name):
+    """The CFI steps from the child of the top level element down to element, as readium-cfi's createCFIElementSteps makes them."""
+    steps = []
+    while True:
+        parent = element['parent']
+        element_id = element['attributes'].get('id')
+        steps.append(f"/{(parent['children'].index(element) + 1) * 2}" + (f"[{element_id}]" if element_id else ''))
+        if xml_local_name(parent['name']) == top_level_name or xml_local_name(element['name']) == top_level_name:
+            return ''.join(reversed(steps))
+        element = parent
+
+def read_spine(epub):
+    """
+    Reads the spine of an open EPUB: idref, href, zip path and package document CFI of every spine item, in reading order.
+    """
+    from urllib.parse import unquote
+
+    with epub.open('META-INF/container.xml') as file:
+        rootfiles = list(iter_xml_elements(parse_xml_elements(file), f"{CONTAINER_NAMESPACE} rootfile"))
+    if len(rootfiles) != 1:
+        raise ValueError(f"Ambiguous nodes in container.xml, size: {len(rootfiles)}")
+    package_path = rootfiles[0]['attributes']['full-path']
+    with epub.open(package_path) as file:
+        package = parse_xml_elements(file)
+
+    items = {}
+    for item in iter_xml_elements(package, f"{OPF_NAMESPACE} item"):
+        items.setdefault(item['attributes'].get('id'), []).append(item)
+
+    spines = []
+    for spine in iter_xml_elements(package, f"{OPF_NAMESPACE} spine"):
+        for itemref in iter_xml_elements(spine, f"{OPF_NAMESPACE} itemref"):
+            idref = itemref['attributes'].get('idref')
+            if len(items.get(idref, [])) != 1:
+                raise ValueError(f"Ambiguous manifest items for spine item {idref}, size: {len(items.get(idref, []))}")
+            href = items[idref][0]['attributes'].get('href')
+            spines.append({
+                'idref': idref,
+                'href': href,
+                'path': posixpath.normpath(posixpath.join(posixpath.dirname(package_path), unquote(href))),
+                'cfi': cfi_element_steps(itemref, 'package'),
+            })
+    return spines
+
+def spine_text_nodes(file):
+    """
+    Streams one spine document through expat and returns (text, CFI path, xpointer path) for every text node below
+    /html/body that is not just whitespace, in document order. The text is escaped the way xmldom serializes a text
+    node, as that is what the node generator measured and concatenated.
+    """
+    # One frame per open element: its name, element and text children seen so far, and its CFI and xpointer paths.
+    # CFI steps count all siblings; KOReader counts elements by name and skips whitespace-only text nodes.
+    frames = []
+    text = []
+    nodes = []
+    in_cdata = False
+
+    def flush():
+        # Every other kind of node ends a text node, so the buffered text is complete here
+        if not text:
+            return
+        data = ''.join(text)
+        text.clear()
+        parent = frames[-1]
+        in_body = len(frames) >= 2 and frames[0]['name'] == XHTML_HTML and frames[1]['name'] == XHTML_BODY
+        if data.strip(' \t\r\n'):
+            parent['xpointer_texts'] += 1
+            if in_body:
+                nodes.append((data.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), f"{parent['path']}/{parent['texts'] * 2 + 1}:0",
+                              f"{parent['xpointer']}/text()[{parent['xpointer_texts']}]"))
+        parent['texts'] += 1
+
+    def start_element(name, attributes):
+        flush()
+        local_name = xml_local_name(name)
+        path = ''
+        xpointer = ''
+        if frames:
+            parent = frames[-1]
+            parent['elements'] += 1
+            element_id = attributes.get('id')
+            step = f"/{parent['elements'] * 2}" + (f"[{element_id}]" if element_id else '')
+            path = step if parent['local_name'] == 'html' or local_name == 'html' else parent['path'] + step
+            named = parent['named'].get(local_name.lower(), 0) + 1
+            parent['named'][local_name.lower()] = named
+            xpointer = f"{parent['xpointer']}/{local_name.lower()}[{named}]"
+        frames.append({'name': name, 'local_name': local_name, 'elements': 0, 'texts': 0, 'path': path,
+                       'named': {}, 'xpointer_texts': 0, 'xpointer': xpointer})
+
+    def end_element(name):
+        flush()
+        frames.pop()
+
+    def character_data(data):
+        if frames and not in_cdata:
+            text.append(data)
+
+    def start_cdata():
+        nonlocal in_cdata
+        flush()
+        in_cdata = True
+
+    def end_cdata():
+        nonlocal in_cdata
+        in_cdata = False
+
+    parser = new_xml_parser()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    parser.StartCdataSectionHandler = start_cdata
+    parser.EndCdataSectionHandler = end_cdata
+    parser.CommentHandler = lambda data: flush()
+    parser.ProcessingInstructionHandler = lambda target, data: flush()
+    parser.SkippedEntityHandler = lambda name, is_parameter_entity: character_data(f"&{name};")
+    parser.ParseFile(file)
+    return nodes
+
+def spine_text_nodes_task(task):
+    epub_path, path = task
+    with zipfile.ZipFile(epub_path) as epub, epub.open(path) as file:
+        return spine_text_nodes(file)
+
+def generate_cfi_map(epub_path, jobs=1):
+    """
+    Assigns a CFI to every text node in the body of every spine document of an EPUB, in the structure the node
+    epub-cfi-generator produced: full_text, the text of all nodes concatenated, and per spine item its idref, href
+    and content, a list of nodes with their text, offset into full_text (counted from 1), length and CFI. Nodes also
+    carry their KOReader xpointer path, for translating highlight positions directly.
+    Spine documents are streamed one at a time, or parsed on jobs worker processes.
+
+    Args:
+        epub_path: Path to the EPUB file
+        jobs: Number of worker processes parsing spine documents
+    """
+    with zipfile.ZipFile(epub_path) as epub:
+        spines = read_spine(epub)
+        if jobs > 1 and len(spines) > 1:
+            with futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                spine_nodes = list(executor.map(spine_text_nodes_task, [(epub_path, spine['path']) for spine in spines]))
+        else:
+            spine_nodes = []
+            for spine in spines:
+                with epub.open(spine['path']) as file:
+                    spine_nodes.append(spine_text_nodes(file))
+
+    full_text = []
+    offset = 1
+    cfi_spines = []
+    for spine, nodes in zip(spines, spine_nodes):
+        content = []
+        for text, path, xpointer in nodes:
+            content.append({'node': text, 'offset': offset, 'length': len(text), 'cfi': f"{spine['cfi']}!{path}", 'xpointer': xpointer})
+            full_text.append(text)
+            offset += len(text)
+        cfi_spines.append({'idref': spine['idref'], 'href': spine['href'], 'content': content})
+    return {'full_text': ''.join(full_text), 'spines': cfi_spines}
+
+class PdfjsWorker:
+    def __init__(self):
+        """
+        A long-lived `node extract-pdf-text.js --serve` process. Requests go in as JSON lines on stdin,
+        and every page comes back as its own JSON line, so node startup, JSDOM and pdf.js loading are
+        paid once per process instead of once per book.
+        """
+        # Resolve real path of the script (not symlink)
+        script_path = os.path.realpath(__file__)
+        base_dir = os.path.dirname(script_path)
+        js_script_path = os.path.join(base_dir, 'nodescripts', 'extract-pdf-text.js')
+
+        if not os.path.isfile(js_script_path):
+            raise FileNotFoundError(f"Node script not found at: {js_script_path}")
+
+        self.lock = threading.Lock()
+        self.process = subprocess.Popen(
+            ["node", js_script_path, "--serve"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            bufsize=1
+        )
+
+    def extract(self, pdf_path, pages=None):
+        """
+        Args:
+            pdf_path (str): Path to PDF file
+            pages (list|str|None): Page numbers, e.g. [3, 7], "3", "1-5", or None for all pages
+
+        Returns:
+            list of dict: Each item is {'page': int, 'content': {...}}
+        """
+        with self.lock:
+            try:
+                self.process.stdin.write(json.dumps({"path": os.path.abspath(pdf_path), "pages": pages}) + '\n')
+                self.process.stdin.flush()
+            except BrokenPipeError:
+                raise RuntimeError("Node.js worker is not running")
+
+            text_contents = []
+            for line in self.process.stdout:
+                message = json.loads(line)
+                if 'error' in message:
+                    raise RuntimeError(f"Node.js execution failed:\n{message['error']}")
+                if message.get('done'):
+                    return text_contents
+                text_contents.append(message)
+            raise RuntimeError("Node.js worker exited unexpectedly")
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        if self.alive():
+            self.process.stdin.close()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+_pdfjs_worker = None
+_pdfjs_worker_lock = threading.Lock()
+
+def get_pdfjs_worker():
+    """Return the process-wide pdf.js worker, starting it (again) if needed."""
+    global _pdfjs_worker
+    with _pdfjs_worker_lock:
+        if _pdfjs_worker is None or not _pdfjs_worker.alive():
+            _pdfjs_worker = PdfjsWorker()
+            atexit.register(_pdfjs_worker.close)
+        return _pdfjs_worker
+
+def get_pdfjs_text_content(pdf_path, page_spec=None):
+    """
+    Extract text from PDF using Node.js + PDF.js, through the shared worker process
+
+    Args:
+        pdf_path (str): Path to PDF file
+        page_spec (list|str|None): e.g. [3, 7], "3", "1-5", or None for all pages
+
+    Returns:
+        list of dict: Each item is {'page': int, 'content': {...}}
+    """
+    return get_pdfjs_worker().extract(pdf_path, page_spec)
+
+class PdfjsTextItems:
+    # Fractions of the font size that pdf.js's getTextContent (evaluator.js) uses to interpret gaps between glyphs
+    NEGATIVE_SPACE_FACTOR = -0.2
+    SPACE_IN_FLOW_MIN_FACTOR = 0.102
+    SPACE_IN_FLOW_MAX_FACTOR = 0.6
+    VERTICAL_SHIFT_RATIO = 0.25
+
+    def __init__(self, page_height):
+        """
+        Builds pdf.js text items from MuPDF characters fed in content stream order, following the rules of pdf.js's
+        getTextContent: real spaces are dropped and spaces re-inserted from the gaps between glyphs, a gap wider than
+        a space becomes an item of its own holding ' ', a change of font closes the current item, and a line break
+        marks the current item with hasEOL, or adds an empty hasEOL item when there is no current item.
+
+        Args:
+            page_height: Height of the page, to turn MuPDF's top-down coordinates into PDF ones
+        """
+        self.page_height = page_height
+        self.items = []
+        self.current = None
+        self.previous = None
+
+    def transform(self, x, y, size, direction):
+        cos, sin = direction
+        return [size * cos, -size * sin, size * sin, size * cos, x, self.page_height - y]
+
+    def flush(self):
+        if self.current is not None:
+            self.items.append(self.current)
+            self.current = None
+
+    def end_of_line(self, transform, font):
+        if self.current is not None:
+            self.current['hasEOL'] = True
+            self.flush()
+        else:
+            self.items.append({'str': '', 'dir': 'ltr', 'width': 0, 'height': 0, 'transform': transform, 'fontName': font, 'hasEOL': True})
+
+    def whitespace(self, width, transform, font):
+        self.flush()
+        self.items.append({'str': ' ', 'dir': 'ltr', 'width': width, 'height': 0, 'transform': transform, 'fontName': font, 'hasEOL': False})
+
+    def add(self, char, font, size, direction):
+        if char['c'].isspace():
+            # The gap it leaves is turned into a space by the next glyph, as in pdf.js
+            return
+        cos, sin = direction
+        x, y = char['origin']
+        x0, y0, x1, y1 = char['bbox']
+        advance = abs((x1 - x0) * cos) + abs((y1 - y0) * sin)
+        transform = self.transform(x, y, size, direction)
+        if self.current is not None and (self.current['fontName'] != font or self.current['height'] != size):
+            self.flush()
+
+        if self.previous is not None:
+            end_x, end_y, previous_size, previous_font, previous_transform = self.previous
+            advance_x = (x - end_x) * cos + (y - end_y) * sin
+            advance_y = (y - end_y) * cos - (x - end_x) * sin
+            if advance_x < self.NEGATIVE_SPACE_FACTOR * previous_size:
+                if abs(advance_y) > 0.5 * previous_size:
+                    self.end_of_line(transform, font)
+                else:
+                    self.flush()
+            elif abs(advance_y) > previous_size:
+                self.end_of_line(transform, font)
+            elif advance_x <= self.SPACE_IN_FLOW_MIN_FACTOR * previous_size:
+                if self.current is not None and abs(advance_y) > self.VERTICAL_SHIFT_RATIO * previous_size:
+                    self.whitespace(0, transform, font)
+            elif advance_x <= self.SPACE_IN_FLOW_MAX_FACTOR * previous_size:
+                if self.current is not None:
+                    self.current['str'] += ' '
+                else:
+                    self.whitespace(advance_x, transform, font)
+            else:
+                self.whitespace(advance_x, previous_transform, previous_font)
+
+        if self.current is None:
+            self.current = {'str': '', 'dir': 'ltr', 'width': 0, 'height': size, 'transform': transform, 'fontName': font, 'hasEOL': False}
+        self.current['str'] += char['c']
+        end_x = x + advance * cos
+        end_y = y + advance * sin
+        self.current['width'] = (end_x - self.current['transform'][4]) * cos + (self.page_height - end_y - self.current['transform'][5]) * -sin
+        self.previous = (end_x, end_y, size, font, self.transform(end_x, end_y, size, direction))
+
+    def finish(self):
+        self.flush()
+        return self.items
+
+def get_pymupdf_text_content(pdf_context, page_numbers):
+    """
+    Rebuild pdf.js-style text content with PyMuPDF, without node.
+
+    MuPDF's characters are fed through PdfjsTextItems in content stream order, which applies pdf.js's rules for
+    spaces, items and line ends. Ligatures are expanded, as pdf.js normalizes them.
+
+    Args:
+        pdf_context (PdfContext): The opened document
+        page_numbers (list): Page numbers to extract
+
+    Returns:
+        list of dict: Each item is {'page': int, 'content': {...}}, shaped like get_pdfjs_text_content
+    """
+    flags = fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_INHIBIT_SPACES | fitz.TEXT_MEDIABOX_CLIP
+    text_contents = []
+    for page_number in page_numbers:
+        if page_number < 1 or page_number > len(pdf_context.fitz_doc):
+            continue
+        page = pdf_context.fitz_doc[page_number - 1]
+        builder = PdfjsTextItems(page.rect.height)
+        for block in page.get_text("rawdict", flags=flags, sort=False)['blocks']:
+            if block.get('type', 0) != 0:
+                continue
+            for line in block['lines']:
+                for span in line['spans']:
+                    for char in span['chars']:
+                        builder.add(char, span['font'], span['size'], line['dir'])
+        text_contents.append({'page': page_number, 'content': {'items': builder.finish(), 'styles': {}}})
+    return text_contents
+
+def remove_whitespace(text):
+    return re.sub(r'\s+', '', text)
+
+def get_page_offset(reader, page_index):
+    if page_index >= len(reader.pages):
+        raise ValueError('Invalid page index')
+
+    offset = 0
+    for i in range(page_index):
+        page_text = reader.pages[i].extract_text()
+        offset += len(page_text)
+
+    return offset
+
+def calculate_page_offsets(pdf_context):
+    page_offsets = [0]  # Initialize with 0 for the first page
+    cumulative_length = 0
+
+    for page_number in range(1, pdf_context.page_count + 1):
+        text = pdf_context.page_text(page_number)
+        cumulative_length += len(text)
+        page_offsets.append(cumulative_length)
+
+    return page_offsets
+
+def find_closest_match(haystack, needle, stats=None):
+    needle_length = len(needle)
+    best_match = None
+    best_score = 0
+    best_index = -1
+
+    for i in range(len(haystack) - needle_length + 1):
+        segment = haystack[i:i + needle_length]
+        score = fuzz.ratio(segment, needle)
+
+        if score > best_score:
+            best_score = score
+            best_match = segment
+            best_index = i
+
+    if stats is not None:
+        stats['windows'] += max(0, len(haystack) - needle_length + 1)
+        stats['score'] = best_score
+    return best_match, best_index
+
+def find_context(pdf_context, page_number, search_string, stats=None):
+    # Ensure page number is within range
+    if page_number < 1 or page_number > pdf_context.page_count:
+        raise ValueError("Page number out of range")
+
+    return find_context_in_page(pdf_context.page_text(page_number), pdf_context.page_offsets[page_number - 1], search_string, stats)
+
+def find_context_in_page(original_text, page_start_offset, search_string, stats=None):
+    # Find the closest match in the text of the specified page
+    _, match_index = find_closest_match(original_text, search_string, stats)
+
+    # Calculate global start and end positions in the entire document
+    global_start_pos = page_start_offset + match_index
+    global_end_pos = page_start_offset + match_index + len(search_string)
+
+    # Calculate local start and end positions for preceding and succeeding text on the page
+    local_start_pos = max(0, match_index - 31)
+    local_end_pos = min(len(original_text), match_index + len(search_string) + 31)
+
+    # Extract preceding and succeeding text
+    preceding_text = original_text[local_start_pos:match_index]
+    succeeding_text = original_text[match_index + len(search_string):local_end_pos]
+
+    return {
+            "preceding": preceding_text,
+            "succeeding": succeeding_text,
+            "start_pos": global_start_pos,
+            "end_pos": global_end_pos
+            }
+
+def find_best_window_exhaustive(full_text, target_norm, min_len, max_len, stats=None):
+    best_match = None
+    best_ratio = 0
+    if stats is not None:
+        stats['windows'] += sum(max(0, len(full_text) - window_len + 1) for window_len in range(min_len, max_len + 1))
+
+    for window_len in range(min_len, max_len + 1):
+        for i in range(len(full_text) - window_len + 1):
+            window = full_text[i:i + window_len]
+            ratio = fuzz.ratio(target_norm, window.lower())
+            if ratio > best_ratio:
+                best_ratio = ratio
+                best_match = (i, i + window_len)  # (start_global, end_global)
+
+    return best_match, best_ratio
+
+def find_anchor_regions(text_norm, target_norm, max_drift, gram_size=4, max_candidates=5, max_gram_occurrences=50):
+    """
+    Locate the regions of text_norm where target_norm most likely sits, by letting every shared
+    n-gram vote for the diagonal (text position minus target position) it lies on.
+
+    Returns a list of (first_start, last_start, first_end, last_end) tuples, best supported first.
+    """
+    positions = {}
+    for i in range(len(text_norm) - gram_size + 1):
+        positions.setdefault(text_norm[i:i + gram_size], []).append(i)
+
+    anchors = []
+    for j in range(len(target_norm) - gram_size + 1):
+        occurrences = positions.get(target_norm[j:j + gram_size])
+        if occurrences and len(occurrences) <= max_gram_occurrences:
+            anchors.extend((p - j, j) for p in occurrences)
+    if not anchors:
+        return []
+
+    anchors.sort()
+    diagonals = [diagonal for diagonal, _ in anchors]
+
+    # Votes for each diagonal, counting every anchor within max_drift of it
+    votes = []
+    low = high = 0
+    for diagonal in diagonals:
+        while diagonals[low] < diagonal - max_drift:
+            low += 1
+        while high < len(diagonals) and diagonals[high] <= diagonal + max_drift:
+            high += 1
+        votes.append((high - low, diagonal, low, high))
+
+    regions = []
+    chosen = []
+    quarter = max(1, len(target_norm) // 4)
+    for _, diagonal, low, high in sorted(votes, key=lambda vote: (-vote[0], vote[1])):
+        if any(abs(diagonal - other) <= max_drift + len(target_norm) // 2 for other in chosen):
+            continue
+        chosen.append(diagonal)
+        supporting = anchors[low:high]
+        # Anchors near either end of the target bound where the match may start and end
+        head = [anchor_diagonal for anchor_diagonal, j in supporting if j < quarter] or [diagonal]
+        tail = [anchor_diagonal for anchor_diagonal, j in supporting if j >= len(target_norm) - quarter - gram_size] or [diagonal]
+        regions.append((min(head), max(head), min(tail) + len(target_norm), max(tail) + len(target_norm)))
+        if len(regions) == max_candidates:
+            break
+    return regions
+
+def find_best_window(full_text, target_norm, min_len, max_len, stats=None):
+    """
+    Find the window of full_text that best matches target_norm, scoring like find_best_window_exhaustive
+    (fuzz.ratio, shortest window and then leftmost start winning ties) but only around n-gram anchors.
+    """
+    text_norm = full_text.lower()
+    if len(text_norm) != len(full_text):
+        # Lowercasing changed the length (e.g. dotted capital I), so positions would not line up.
+        return find_best_window_exhaustive(full_text, target_norm, min_len, max_len, stats)
+
+    # Exact fast path: the first occurrence wins, unless the target is long enough that a window one
+    # character shorter also rounds to 100 and would win the tie
+    exact_index = text_norm.find(target_norm)
+    if exact_index != -1 and len(target_norm) > 1 and fuzz.ratio(target_norm, target_norm[:-1]) < 100:
+        if stats is not None:
+            stats['windows'] += 1
+        return (exact_index, exact_index + len(target_norm)), 100
+
+    max_drift = max_len - len(target_norm)
+    regions = find_anchor_regions(text_norm, target_norm, max_drift)
+    if not regions or len(target_norm) < 16:
+        # Short targets are cheap to scan in full, and without shared n-grams there is nothing to anchor on
+        return find_best_window_exhaustive(full_text, target_norm, min_len, max_len, stats)
+
+    # Bounded extension: every start and end within slack of the anchored bounds
+    slack = max(8, len(target_norm) // 8)
+    windows = set()
+    for first_start, last_start, first_end, last_end in regions:
+        for start in range(max(0, first_start - slack), min(len(text_norm), last_start + slack) + 1):
+            for end in range(max(start + min_len, first_end - slack), min(start + max_len, last_end + slack, len(text_norm)) + 1):
+                windows.add((end - start, start))
+    if stats is not None:
+        stats['windows'] += len(windows)
+
+    best_match = None
+    best_ratio = 0
+    for window_len, start in sorted(windows):
+        ratio = fuzz.ratio(target_norm, text_norm[start:start + window_len])
+        if ratio > best_ratio:
+            best_ratio = ratio
+            best_match = (start, start + window_len)
+
+    return best_match, best_ratio
+
+def find_highlight_rects(words, highlight, stats=None):
+    """
+    Locate a highlight among a page's words and return one rectangle per line it covers, built from the
+    matched word boxes. Returns an empty list if nothing on the page matches well enough.
+
+    Args:
+        words: The page's words, as returned by fitz's page.get_text("words")
+        highlight: The highlighted passage
+    """
+    target_norm = ' '.join(highlight.split()).lower()
+    if not target_norm or not words:
+        return []
+
+    # The page as its words joined by single spaces, remembering where each word sits
+    spans = []
+    position = 0
+    for word in words:
+        spans.append((position, position + len(word[4])))
+        position += len(word[4]) + 1
+    full_text = ' '.join(word[4] for word in words)
+
+    min_len = max(1, int(len(target_norm) * 0.75))
+    max_len = int(len(target_norm) * 1.25)
+    best_match, best_ratio = find_best_window(full_text, target_norm, min_len, max_len, stats)
+    if stats is not None:
+        stats['score'] = best_ratio
+    if not best_match or best_ratio < 70:
+        return []
+
+    start, end = best_match
+    lines = {}
+    for word, (word_start, word_end) in zip(words, spans):
+        if word_start < end and word_end > start:
+            line = (word[5], word[6])
+            if line in lines:
+                lines[line] |= fitz.Rect(word[:4])
+            else:
+                lines[line] = fitz.Rect(word[:4])
+    return list(lines.values())
+
+def find_string(text_contents, target_string, stats=None):
+    items = text_contents['content']['items']
+    full_text = ''.join(item['str'] for item in items)
+    
+    # Fuzzy-match to find the best substring (variable length)
+    target_norm = target_string.lower()
+    
+    # Search with a sliding window (±25% of target length)
+    min_len = max(1, int(len(target_string) * 0.75))
+    max_len = int(len(target_string) * 1.25)
+    
+    best_match, best_ratio = find_best_window(full_text, target_norm, min_len, max_len, stats)
+    if stats is not None:
+        stats['score'] = best_ratio
+    
+    if not best_match or best_ratio < 70:  # Threshold adjustable
+        return None
+    
+    start_global, end_global = best_match
+    
+    # Map global positions to item indices and relative offsets
+    start_item_idx, start_offset = None, None
+    end_item_idx, end_offset = None, None
+    current_pos = 0
+    
+    for idx, item in enumerate(items):
+        item_start = current_pos
+        item_end = current_pos + len(item['str'])
+        
+        # Check if match starts in this item
+        if start_item_idx is None and item_start <= start_global < item_end:
+            start_item_idx = idx
+            start_offset = start_global - item_start  # Relative to item start
+        
+        # Check if match ends in this item
+        if end_item_idx is None and item_start < end_global <= item_end:
+            end_item_idx = idx
+            end_offset = end_global - item_start  # Relative to item end
+        
+        current_pos = item_end
+    
+    return {
+        'start_text_content_id': start_item_idx,  # Index of the starting item
+        'start_text_offset': start_offset,         # Offset within starting item
+        'end_text_content_id': end_item_idx,      # Index of the ending item
+        'end_text_offset': end_offset             # Offset within ending item
+    }
+
+def selection_from_match(result):
+    if not result:
+        return None
+    return {
+        'id': result['start_text_content_id'],
+        'start': result['start_text_offset'],
+        'end_id': result['end_text_content_id'],
+        'end': result['end_text_offset']
+    }
+
+# Page data for the resolution pool, shipped once to each worker process by its initializer
+_resolution_pages = None
+
+def init_resolution_worker(pages):
+    global _resolution_pages
+    _resolution_pages = pages
+
+def resolve_anchor_task(task):
+    kind, page_number, needle = task
+    page = _resolution_pages[page_number]
+    # Match diagnostics travel back with the result, for --profile
+    stats = new_match_stats()
+    start_time = time.perf_counter()
+    if kind == 'context':
+        result = find_context_in_page(page['text'], page['offset'], needle, stats)
+    else:
+        result = selection_from_match(find_string(page['text_content'], needle, stats))
+    stats['seconds'] = time.perf_counter() - start_time
+    return result, stats
+
+def lua_table_to_python(value):
+    """
+    Convert a Lua value into plain Python data, shaped the way dkjson would have encoded it: tables
+    whose keys are all positive integers become lists (holes become None, and an empty table is an
+    empty list), every other table becomes a dict with string keys.
+    """
+    if lupa.lua_type(value) != 'table':
+        return value
+
+    entries = list(value.items())
+    max_index = 0
+    array_length = 0
+    is_array = True
+    for key, item in entries:
+        if key == 'n' and isinstance(item, (int, float)):
+            array_length = item
+            max_index = max(max_index, item)
+        elif isinstance(key, (int, float)) and not isinstance(key, bool) and key >= 1 and int(key) == key:
+            max_index = max(max_index, key)
+        else:
+            is_array = False
+            break
+    # Like dkjson, don't create an array with too many holes
+    if is_array and max_index > 10 and max_index > array_length and max_index > (len(entries) - (1 if array_length else 0)) * 2:
+        is_array = False
+
+    if is_array:
+        result = [None] * int(max_index)
+        for key, item in entries:
+            if key != 'n':
+                result[int(key) - 1] = lua_table_to_python(item)
+        return result
+
+    result = {}
+    for key, item in entries:
+        if isinstance(key, float) and key.is_integer():
+            key = int(key)
+        result[str(key)] = lua_table_to_python(item)
+    return result
+
+def load_metadata_lua(lua_path):
+    """
+    Load a KOReader metadata.*.lua sidecar straight into Python dicts and lists.
+
+    The sidecar is a text-only chunk that returns one table, so it is run with an empty environment:
+    it cannot reach io, os or require.
+    """
+    with open(lua_path, 'r', encoding='utf-8') as file:
+        source = file.read()
+    lua = lupa.LuaRuntime(unpack_returned_tuples=True)
+    load_sidecar = lua.eval("""function(source, name)
+        local chunk, err = load(source, name, "t", {})
+        if not chunk then error(err) end
+        return chunk()
+    end""")
+    return lua_table_to_python(load_sidecar(source, '@' + lua_path))
+
+def is_cfi_in_booknotes(book_json_data, target_cfi):
+    """Check if a CFI exists in the booknotes."""
+    return any(annotation.get("cfi") == target_cfi 
+              for annotation in book_json_data.get("booknotes", []))
+
+def get_annotation_by_cfi(book_json_data, target_cfi):
+    """Return the annotation matching the CFI, or None if not found."""
+    return next(
+        (annotation for annotation in book_json_data.get("booknotes", []) 
+         if annotation.get("cfi") == target_cfi),
+        None
+    )
+
+
+class CompiledTemplate:
+    def __init__(self, template):
+        """
+        A str.format template parsed once, to be rendered many times. Rendering gives the same result as
+        template.format(**values), and fields lists the names the template uses, so callers only need to
+        compute those values.
+
+        Args:
+            template: The template, in str.format syntax
+        """
+        self.formatter = string.Formatter()
+        self.parts = []
+        self.fields = set()
+        for literal, field_name, format_spec, conversion in self.formatter.parse(template):
+            if field_name is not None:
+                self.fields.add(re.split(r'[.\[]', field_name, maxsplit=1)[0])
+                if format_spec and '{' in format_spec:
+                    # Nested fields in the format spec, e.g. {text:>{width}}
+                    format_spec = CompiledTemplate(format_spec)
+                    self.fields |= format_spec.fields
+            self.parts.append((literal, field_name, format_spec, conversion))
+
+    def render(self, values):
+        chunks = []
+        for literal, field_name, format_spec, conversion in self.parts:
+            chunks.append(literal)
+            if field_name is not None:
+                value, _ = self.formatter.get_field(field_name, (), values)
+                value = self.formatter.convert_field(value, conversion)
+                if isinstance(format_spec, CompiledTemplate):
+                    format_spec = format_spec.render(values)
+                chunks.append(self.formatter.format_field(value, format_spec))
+        return ''.join(chunks)
+
+def default_markdown_template():
+    return_string = """# {title} annotations
+{author}
+{filename}
+%annotation
+---
+> [!quote] &nbsp;
+> =={highlight}== (p. {page_number})
+
+> [!note] &nbsp;
+> {text}
+"""
+    return return_string
+
+def default_epub_markdown_template():
+    return_string = """# {title} annotations
+{author}
+{filename}
+%annotation
+---
+> [!quote] &nbsp;
+> =={highlight}== (chp. {chapter})
+
+> [!note] &nbsp;
+> {text}
+"""
+    return return_string
+
+def hexify(byte_string):
+    return byte_string.hex()
+
+
+def hash_of_first_kilobyte(pdf_context):
+    h = hashlib.md5()
+    h.update(pdf_context.head(1024))
+    return h.hexdigest()
+
+PDF_LITERAL_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f', b'(': b'(', b')': b')', b'\\': b'\\'}
+
+def decode_pdf_literal(raw):
+    def replace(match):
+        escape = match.group(1)
+        if escape[:1].isdigit():
+            return bytes((int(escape, 8) & 0xFF,))
+        if escape in (b'\r\n', b'\r', b'\n'):
+            return b''  # Escaped line break, i.e. a continued line
+        return PDF_LITERAL_ESCAPES.get(escape, escape)
+    return re.sub(rb'\\([0-7]{1,3}|\r\n|.)', replace, raw, flags=re.S)
+
+def file_id_from_trailer(path):
+    """
+    Return the PDF file identifier as a hex string, read straight from the trailer (or cross-reference stream)
+    that the final startxref points to, without parsing the document. Only the tail of the memory-mapped file
+    and that one dictionary are touched.
+
+    Returns None if the file is not shaped as expected, in which case file_id_from should be used.
+    """
+    try:
+        with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            size = len(data)
+            startxref = data.rfind(b'startxref', max(0, size - 4096))
+            if startxref == -1:
+                return None
+            match = re.match(rb'startxref\s+(\d+)', data[startxref:startxref + 64])
+            if match is None or int(match.group(1)) >= startxref:
+                return None
+            offset = int(match.group(1))
+            if data[offset:offset + 4] == b'xref':
+                trailer = data.rfind(b'trailer', offset, startxref)
+                if trailer == -1:
+                    return None
+                dictionary = data[trailer:startxref]
+            elif re.match(rb'\d+\s+\d+\s+obj', data[offset:offset + 32]):
+                end = data.find(b'stream', offset, min(startxref, offset + 65536))
+                if end == -1:
+                    return None
+                dictionary = data[offset:end]
+                if b'/XRef' not in dictionary:
+                    return None
+            else:
+                return None
+    except (FileNotFoundError, ValueError):
+        # Missing files are reported by file_id_from, and empty ones cannot be mapped
+        return None
+
+    match = re.search(rb'/ID\s*\[\s*(?:<([0-9A-Fa-f\s]*)>|\(((?:\\.|[^\\()\r])*)\))', dictionary, re.S)
+    if match is None:
+        return None
+    if match.group(1) is not None:
+        hex_digits = re.sub(rb'\s', b'', match.group(1))
+        if len(hex_digits) % 2:
+            return None
+        return hexify(bytes.fromhex(hex_digits.decode('ascii')))
+    return hexify(decode_pdf_literal(match.group(2)))
+
+
+def file_id_from(pdf_context):
+    """
+    Return the PDF file identifier from the given document as a hex string.
+
+    Returns None if the document doesn't contain a file identifier.
+
+    """
+    import pdfminer.pdfparser
+    import pdfminer.pdfdocument
+
+    try:
+        with open(pdf_context.path, 'rb') as f:
+            parser = pdfminer.pdfparser.PDFParser(f)
+            document = pdfminer.pdfdocument.PDFDocument(parser)
+
+            for xref in document.xrefs:
+                if xref.trailer:
+                    trailer = xref.trailer
+
+                    try:
+                        id_array = trailer["ID"]
+                    except KeyError:
+                        continue
+
+                    # Resolve indirect object references.
+                    try:
+                        id_array = id_array.resolve()
+                    except AttributeError:
+                        pass
+
+                    try:
+                        file_id = id_array[0]
+                    except TypeError:
+                        continue
+
+                    return hexify(file_id)
+    except FileNotFoundError:
+        print('PDF not found. Abort.')
+        sys.exit(0)
+
+
+def get_fingerprint(pdf_context):
+    print('Fingerprinting.')
+    return file_id_from_trailer(pdf_context.path) or file_id_from(pdf_context) or hash_of_first_kilobyte(pdf_context)
+
+def find_relative_path_to_pdf(absolute_pdf_path):
+    # Split the path into parts
+    path_parts = absolute_pdf_path.split(os.sep)
+
+    for i in range(len(path_parts) - 1, 0, -1):
+        # Reconstruct the path up to the current part
+        current_path = os.sep.join(path_parts[:i])
+
+        # Check if the '.obsidian' or '.obsidian.nosync' directory exists in the current path
+        if os.path.exists(os.path.join(current_path, '.obsidian')) or os.path.exists(os.path.join(current_path, '.obsidian.nosync')):
+            # Return the relative path from the next directory after this one to the PDF
+            return os.sep.join(path_parts[i:])
+
+    return None
+
+def parse_choices(choice_str = 'obs,md'):
+    choices = choice_str.split(',')
+    for choice in choices:
+        if choice not in OUTPUT_FORMATS:
+            raise argparse.ArgumentTypeError(f"{choice} is not a valid choice.")
+    return choices
+
+# Output formats by every name they can be selected by, filled in by the output_format decorator
+OUTPUT_FORMATS = {}
+# Modules that resolving each kind of anchor needs, on top of the requirements of the formats reading it
+ANCHOR_REQUIREMENTS = {'context': ('PyPDF2', 'thefuzz.fuzz'), 'selection': ('thefuzz.fuzz',), 'rects': ('fitz',)}
+# Modules each --text-backend needs to produce the text items selection anchors are resolved against
+TEXT_BACKEND_REQUIREMENTS = {'pdfjs': (), 'pymupdf': ('fitz',)}
+
+def output_format(name, aliases=(), file_types=('pdf', 'epub'), requires=(), anchors=()):
+    """
+    Registers a KohicoSession writer as an output format.
+
+    Args:
+        name: Name of the format
+        aliases: Other names the format can be selected by
+        file_types: Book types the format applies to
+        requires: Modules the writer needs, imported only when the format is selected
+        anchors: What the writer reads from each annotation, resolved beforehand: 'context', 'selection' and/or 'rects'.
+            The modules resolving them need are listed in ANCHOR_REQUIREMENTS.
+    """
+    def register(writer):
+        entry = {'name': name, 'writer': writer, 'file_types': file_types, 'requires': requires, 'anchors': anchors}
+        for key in (name, *aliases):
+            OUTPUT_FORMATS[key] = entry
+        return writer
+    return register
+
+def format_requirements(conversion_type, resolve_anchors=True, text_backend='pdfjs'):
+    entry = OUTPUT_FORMATS[conversion_type]
+    modules = list(entry['requires'])
+    if resolve_anchors:
+        for anchor in entry['anchors']:
+            required = ANCHOR_REQUIREMENTS[anchor]
+            if anchor == 'selection':
+                required += TEXT_BACKEND_REQUIREMENTS[text_backend]
+            modules.extend(module for module in required if module not in modules)
+    return modules
+
+def load_format_requirements(conversion_types, resolve_anchors=True, text_backend='pdfjs'):
+    """
+    Imports what the selected formats need, exiting with a hint when a module is missing. Anchors are not resolved
+    for EPUBs or a metadata file passed directly, so their requirements are left out then.
+    """
+    for conversion_type in conversion_types:
+        entry = OUTPUT_FORMATS[conversion_type]
+        for module in format_requirements(conversion_type, resolve_anchors, text_backend):
+            try:
+                importlib.import_module(module)
+            except ImportError:
+                print(f"The {entry['name']} output format needs the Python module '{module}'. Install the requirements with 'pip install -r requirements.txt'. Exiting.")
+                sys.exit(0)
+
+class KohicoSession:
+    def __init__(self, args, pdf_context=None):
+        """
+        Carries everything one conversion needs: its paths, the opened document, caches and the resulting annotations.
+        Sessions share no state, so several books can be converted in one process, concurrently or one after another.
+
+        Args:
+            args: Namespace with file_path, output_format, template, no_cache, cache_size, text_backend, full, incremental, jobs, profile and cprofile, as built by build_parser
+            pdf_context: Optional already opened PdfContext for file_path, owned (and its cache closed) by the caller
+        """
+        self.args = args
+        self.file_path = args.file_path
+        self.needs_context = True
+        self.raw_vault_path = None
+        self.vault_path = None
+        self.fingerprint = None
+        self.file_hash = None
+        self.document = None
+        self.pdf_context = pdf_context
+        self.owns_pdf_context = pdf_context is None
+        self.cache = None
+        self.state = None
+        self.baked_ids = None
+        self.json_data = None
+        self.profiler = Profiler(args.profile, args.cprofile, args.trace_memory)
+        self.annotations = []
+
+    def run(self):
+        self.profiler.start()
+        try:
+            with self.profiler.stage('prepare'):
+                self.prepare()
+            # Counted before the writers run, as the pdfplus writer narrows self.annotations to the new ones
+            self.profiler.annotation_count = len(self.annotations)
+
+            for conversion_type in self.args.output_format:
+                with self.profiler.stage(f"write {OUTPUT_FORMATS[conversion_type]['name']}"):
+                    OUTPUT_FORMATS[conversion_type]['writer'](self)
+
+            with self.profiler.stage('finish'):
+                self.finish()
+        finally:
+            self.profiler.stop(self)
+        print('All done.')
+        return self.annotations
+
+    def prepare(self):
+        """
+        Everything before the writers: opens the document, reads the metadata and resolves the anchors the selected
+        output formats need.
+        """
+        print('Initiating.')
+
+        if self.file_path[-3:] == 'lua':
+            print("You have passed the metadata file directly instead of a PDF or epub. The only available output formats are: 'markdown'/'md'.")
+            if not all(item in ['md', 'markdown'] for item in self.args.output_format):
+                print('One of the selected conversion types is not available. Exiting.')
+                sys.exit(0)
+            self.needs_context = False
+
+        with self.profiler.stage('imports'):
+            # Imported up front, so that the stages below time their own work rather than the imports it triggers.
+            # Anchors are only resolved for PDFs.
+            lupa.load()
+            load_format_requirements(self.args.output_format, self.needs_context and self.file_type() == 'pdf', self.args.text_backend)
+
+        self.raw_vault_path = find_relative_path_to_pdf(self.file_path)
+        self.vault_path = 'vault:/' + self.raw_vault_path if self.raw_vault_path is not None else None
+
+        if self.needs_context and self.owns_pdf_context:
+            if not self.args.no_cache and (self.file_type() == "pdf" or 'readest' in self.args.output_format):
+                self.cache = ExtractionCache(max_bytes=self.args.cache_size * 1024 * 1024)
+            self.pdf_context = PdfContext(self.file_path, self.cache, self.args.text_backend)
+
+        if 'obs' in self.args.output_format or 'obsidian-annotator' in self.args.output_format:
+            with self.profiler.stage('fingerprint'):
+                self.fingerprint = self.pdf_context.fingerprint
+        else:
+            self.fingerprint = 'na'
+            
+        if 'readest' in self.args.output_format:
+            self.file_hash = get_readest_bookkey(self.file_path)
+
+        with self.profiler.stage('lua_to_json'):
+            json_data = self.lua_to_json(self.file_type())
+        if self.file_type() == "epub":
+            self.needs_context = False
+        if not self.args.full:
+            self.state = self.load_state()
+        self.json_data = json_data
+        with self.profiler.stage('process_annotations'):
+            self.process_annotations(json_data)
+
+        with self.profiler.stage('resolve_anchors'):
+            self.resolve_anchors(self.args.output_format)
+
+    def finish(self):
+        if self.state is not None:
+            self.state.save()
+
+        if self.owns_pdf_context and self.pdf_context is not None:
+            self.pdf_context.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def file_type(self):
+        if self.file_path[-7:] == 'pdf.lua':
+            return 'pdf'
+        elif self.file_path[-3:] == 'pdf':
+            return 'pdf'
+        elif self.file_path[-8:] == 'epub.lua':
+            return 'epub'
+        elif self.file_path[-4:] == 'epub':
+            return 'epub'
+        else:
+            return 'pdf'
+
+    def metadata_path(self, file_type):
+        # Decided by the path alone: needs_context is also cleared for EPUBs, whose metadata still lives in the .sdr directory
+        if self.file_path[-3:] == 'lua':
+            lua_path = self.file_path
+        else:
+            if file_type == "pdf":
+                sdr_directory = self.file_path.replace('.pdf', '', 1) + '.sdr'
+                lua_path = os.path.dirname(self.file_path) + '/' + os.path.basename(sdr_directory) + '/metadata.pdf.lua'
+            elif file_type == "epub":
+                sdr_directory = self.file_path.replace('.epub', '', 1) + '.sdr'
+                lua_path = os.path.dirname(self.file_path) + '/' + os.path.basename(sdr_directory) + '/metadata.epub.lua'
+        return lua_path
+
+    def lua_to_json(self, file_type):
+        print('Converting metadata to JSON.')
+        return load_metadata_lua(self.metadata_path(file_type))
+
+    def load_state(self):
+        # Lives in the .sdr directory next to the metadata, keyed to the exact version of the book file
+        state_path = os.path.join(os.path.dirname(self.metadata_path(self.file_type())), 'kohico.state.json')
+        stat = os.stat(self.file_path)
+        return RunState(state_path, f"{stat.st_size}:{stat.st_mtime_ns}")
+
+    def process_annotations(self, json_data):
+        print('Processing annotations.')
+        # Process annotations
+        if 'author' not in json_data['doc_props'] and 'authors' not in json_data['doc_props']:
+            author = 'Unknown'
+        elif 'author' in json_data['doc_props']:
+            author = json_data['doc_props']['author']
+        elif 'authors' in json_data['doc_props']:
+            author = json_data['doc_props']['authors']
+        self.document = Document(json_data['doc_props']['title'], author)
+        if "bookmarks" in json_data:
+            for bookmark in json_data["bookmarks"]:
+                page_no = bookmark.get("page", 1)
+                text = bookmark.get("text", "")
+                notes = bookmark.get("notes", "No notes available")
+                title = json_data['doc_props']['title']
+                unique_id = annotation_id(page_no, bookmark.get("pos0"), bookmark.get("pos1"), text)
+                self.annotations.append(Annotation(self.fingerprint, title, self.vault_path, text, notes, self.pdf_context, page_no, None, None, author=self.document.author, raw_vault_path=self.raw_vault_path, unique_id=unique_id, highlight=notes))
+        if "annotations" in json_data:
+            for bookmark in json_data["annotations"]:
+                page_no = bookmark.get("page", 1)
+                text = bookmark.get("text", "")
+                notes = bookmark.get("note", " ")
+                chapter = bookmark.get("chapter", " ")
+                title = json_data['doc_props']['title']
+                unique_id = annotation_id(page_no, bookmark.get("pos0"), bookmark.get("pos1"), text)
+                self.annotations.append(Annotation(self.fingerprint, title, self.vault_path, text, notes, self.pdf_context, page_no, None, chapter, author=self.document.author, raw_vault_path=self.raw_vault_path, unique_id=unique_id))
+        if self.state is not None:
+            self.state.prune({annotation.unique_id for annotation in self.annotations})
+            for annotation in self.annotations:
+                context = self.state.resolved(annotation.unique_id, 'context', annotation.notes)
+                if context is not None:
+                    annotation.set_context(context)
+                selection = self.state.resolved(annotation.unique_id, self.selection_kind(), annotation.text)
+                if selection is not None:
+                    annotation.set_selection(selection)
+
+    def selection_kind(self):
+        return f"selection:{self.args.text_backend}"
+
+    def resolve_anchors(self, conversion_types):
+        """
+        Resolves, once per annotation, every anchor the requested output formats read, and memoizes them on the
+        annotation so that each extra format costs next to nothing. Formats that do not need an anchor never pay for it.
+
+        Args:
+            conversion_types: The requested output formats
+        """
+        anchors = {anchor for conversion_type in conversion_types for anchor in OUTPUT_FORMATS[conversion_type]['anchors']}
+        uses_context = 'context' in anchors
+        uses_selection = 'selection' in anchors
+        uses_rects = 'rects' in anchors
+
+        context_pending = []
+        for annotation in self.annotations:
+            if 'context' in annotation.resolved:
+                continue
+            if not self.needs_context or not uses_context:
+                annotation.context = {"preceding": 'na', 'succeeding': 'na', 'start_pos': 'na', 'end_pos': 'na'}
+            else:
+                context_pending.append(annotation)
+
+        selection_pending = []
+        if uses_selection and self.needs_context:
+            selection_pending = [annotation for annotation in self.pending_pdf_plus_annotations() if 'selection' not in annotation.resolved]
+            # Only the annotated pages are needed, so fetch exactly those in one go
+            with self.profiler.stage('text content'):
+                self.pdf_context.load_text_contents(annotation.page_number for annotation in selection_pending)
+        if context_pending:
+            with self.profiler.stage('page text'):
+                self.pdf_context.page_offsets
+
+        if self.args.jobs > 1 and len(context_pending) + len(selection_pending) > 1:
+            self.resolve_in_pool(context_pending, selection_pending)
+
+        for annotation in context_pending:
+            if 'context' not in annotation.resolved:
+                with self.profiler.match(annotation, 'context') as stats:
+                    annotation.get_context(stats)
+            if self.state is not None:
+                self.state.set_resolved(annotation.unique_id, 'context', annotation.context, annotation.notes)
+        for annotation in selection_pending:
+            if 'selection' not in annotation.resolved:
+                with self.profiler.match(annotation, 'selection') as stats:
+                    annotation.get_selection_offsets(stats)
+            if self.state is not None and annotation.selection is not None:
+                self.state.set_resolved(annotation.unique_id, self.selection_kind(), annotation.selection, annotation.text)
+
+        if uses_rects and self.needs_context:
+            # Each page's words are extracted once and shared by all of its highlights
+            by_page = {}
+            for annotation in self.pending_bake_annotations():
+                if 'rects' not in annotation.resolved:
+                    by_page.setdefault(annotation.page_number, []).append(annotation)
+            for page_number, page_annotations in sorted(by_page.items()):
+                words = self.pdf_context.fitz_doc[page_number - 1].get_text("words")
+                for annotation in page_annotations:
+                    with self.profiler.match(annotation, 'rects') as stats:
+                        annotation.set_rects(find_highlight_rects(words, annotation.highlight, stats))
+
+    def resolve_in_pool(self, context_pending, selection_pending):
+        """
+        Resolves contexts and selections in worker processes. Each worker gets the text of the annotated pages once,
+        and results come back in submission order, so the outcome is identical to resolving one by one.
+        Highlights on pages outside the document are left for the sequential path, which reports them.
+
+        Args:
+            context_pending: Annotations whose context is still unresolved
+            selection_pending: Annotations whose pdf.js selection offsets are still unresolved
+        """
+        pages = {}
+        for annotation in context_pending:
+            if 1 <= annotation.page_number <= self.pdf_context.page_count:
+                page = pages.setdefault(annotation.page_number, {})
+                page['text'] = self.pdf_context.page_text(annotation.page_number)
+                page['offset'] = self.pdf_context.page_offsets[annotation.page_number - 1]
+        for annotation in selection_pending:
+            pages.setdefault(annotation.page_number, {})['text_content'] = self.pdf_context.text_content(annotation.page_number)
+
+        work = [(annotation, ('context', annotation.page_number, annotation.notes)) for annotation in context_pending if annotation.page_number in pages]
+        work += [(annotation, ('selection', annotation.page_number, annotation.text)) for annotation in selection_pending]
+        jobs = min(self.args.jobs, len(work))
+        if jobs < 2:
+            return
+
+        with futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_resolution_worker, initargs=(pages,)) as executor:
+            results = executor.map(resolve_anchor_task, [task for _, task in work], chunksize=max(1, len(work) // (jobs * 4)))
+            for (annotation, task), (result, stats) in zip(work, results):
+                if task[0] == 'context':
+                    annotation.set_context(result)
+                else:
+                    annotation.set_selection(result)
+                self.profiler.record_match(annotation, task[0], stats)
+
+    def pdf_plus_output_path(self):
+        return self.file_path.replace('.pdf', '', 1) + ' annotations.md'
+
+    def pending_pdf_plus_annotations(self):
+        # Highlights the pdf++ file already got on an earlier run need no resolving at all
+        if self.state is None or not os.path.exists(self.pdf_plus_output_path()):
+            return self.annotations
+        emitted = self.state.emitted('pdfplus')
+        return [annotation for annotation in self.annotations if annotation.unique_id not in emitted]
+
+    @output_format('obsidian-annotator', aliases=('obs',), file_types=('pdf',), requires=('PyPDF2', 'thefuzz.fuzz'), anchors=('context',))
+    def convert_annotations_obsidian_annotator(self):
+        print('Converting annotations (obsidian-annotator).')
+        output_file_name = self.file_path.replace('.pdf', '', 1) + '_obs-anno.md'
+        with atomic_write(output_file_name) as file:
+            file.write(f"annotation-target::[[{self.vault_path.replace('vault:/', '', 1)}]]\n")
+            for annotation in self.annotations:
+                file.write(annotation.hypothesis())
+            file.write('\n')
+        print(f"Annotation file saved as {output_file_name}.")
+        return True
+
+    @output_format('readest', file_types=('epub',), requires=('thefuzz.fuzz',))
+    def convert_annotations_readest(self):
+        print('Converting annotations (readest).')
+        json_data = self.json_data
+        abs_path = os.path.abspath(self.file_path)
+
+        with self.profiler.stage('load_cfi_map'):
+            cfi_map = load_cfi_map(self.file_path, self.file_hash, self.pdf_context.cache if self.pdf_context is not None else self.cache, self.args.jobs)
+
+        annotations = json_data['annotations']
+        generator = CFIGenerator(cfi_map, json_data['stats']['pages'])
+
+        # TODO: Make this multi-platform. macOS only atm.
+        readest_dir = os.path.expanduser("~/Library/Application Support/com.bilingify.readest/Readest/Books")
+        readest_lib = os.path.join(readest_dir, "library.json")
+
+        json_backup_path = self.file_path.replace('.epub', '', 1) + '-backup.json'
+
+        book_dir = os.path.join(readest_dir, self.file_hash)
+        book_json = os.path.join(book_dir, "config.json")
+        ps_aux = subprocess.run(['ps', 'aux'], capture_output=True)
+
+        if "/Applications/Readest.app" in ps_aux.stdout.decode('utf-8'):
+            quit_readest = ""
+            while quit_readest.lower() != "y" and quit_readest.lower() != "n":
+                quit_readest = input("Writing to Readest-files must be done with Readest closed, otherwise, any changes are overwritten when the app is later closed. Quit Readest? (y/n) ")
+
+            if quit_readest.lower() == "y":
+                app_name = "Readest"  # Exact name as seen in the Dock
+                script = f'tell application "{app_name}" to quit'
+                subprocess.run(["osascript", "-e", script])
+
+        if not os.path.exists(book_dir):
+            os.makedirs(book_dir)
+        if not os.path.exists(book_json):
+            initial_book_json = {"viewSettings":{},"searchConfig":{},"updatedAt":int(time.time())}
+            with open(book_json, 'w') as f:
+                f.write(json.dumps(initial_book_json))
+
+        with open(readest_lib, 'r') as f:
+            readest_lib_data = json.load(f)
+
+        in_library = False
+        for book in readest_lib_data:
+            if book['hash'] == self.file_hash:
+                in_library = True
+                break
+
+        if not in_library:
+            readest_lib_data.append({"hash": self.file_hash, "format": "EPUB", "title": json_data['doc_props']['title'], "author": json_data['doc_props']['author'], "primaryLanguage": "en", "createdAt": int(time.time()), "uploadedAt": None, "deletedAt": int(time.time()), "downloadedAt": int(time.time()), "updatedAt": int(time.time()), "filePath": self.file_path})
+
+            with open(readest_lib, 'w') as f:
+                f.write(json.dumps(readest_lib_data))
+
+
+        with open(book_json, 'r') as f:
+            book_json_data = json.load(f)
+
+        book_json_data['booknotes'] = []
+
+
+        for annotation in annotations:
+            start_time = time.perf_counter()
+            cfi = generator.generate_cfi_range(annotation)
+            self.profiler.record_match(None, 'cfi', dict(new_match_stats(), seconds=time.perf_counter() - start_time), page_number=annotation.get('page'), text=annotation.get('text', ''))
+
+
+            if is_cfi_in_booknotes(book_json_data, cfi):
+                existing_annotation = get_annotation_by_cfi(book_json_data, target_cfi)
+                existing_annotation['text'] = annotation['text']
+                existing_annotation['note'] = annotation.get('note', '')
+                existing_annotation['updatedAt'] = int(time.time())
+            else:
+                book_json_data['booknotes'].append(
+                        {"id": generate_readest_uid(),
+                         "type": "annotation",
+                         "cfi": cfi,
+                         "style": "highlight",
+                         "color": "yellow",
+                         "text": annotation['text'],
+                         "note": annotation.get('note', ''),
+                         "createdAt": int(time.time()),
+                         "updatedAt": int(time.time())
+                        }
+                        )
+
+        with open(book_json, 'w') as f:
+            f.write(json.dumps(book_json_data))
+
+        with open(json_backup_path, 'w') as f:
+            f.write(json.dumps(book_json_data))
+
+
+        print("Readest done.")
+        return True
+
+    @output_format('pdfplus', aliases=('pdf++',), file_types=('pdf',), requires=('thefuzz.fuzz',), anchors=('selection',))
+    def convert_annotations_pdf_plus(self):
+        print('Converting annotations (pdfplus).')
+
+        output_file_name = self.pdf_plus_output_path()
+
+        if self.state is not None and not os.path.exists(output_file_name):
+            self.state.forget_emitted('pdfplus')
+        self.annotations[:] = self.pending_pdf_plus_annotations()
+
+        # Check if file exists and read existing content
+        existing_content = ""
+        existing_selections = set()
+
+        try:
+            with open(output_file_name, 'r') as file:
+                existing_content = file.read()
+
+                # Find all existing selections in the file
+                import re
+                existing_selections = set(re.findall(r"selection=([^\|]+)", existing_content))
+        except FileNotFoundError:
+            pass  # File doesn't exist yet, we'll create it
+
+        # Find which new annotations aren't already in the file
+        unique_new_annotations = []
+        current_annotations = self.annotations.copy()
+        self.annotations.clear()  # Clear to rebuild with only new ones
+
+        for i, annotation in enumerate(current_annotations):
+            # Get the selection for this annotation
+            temp_md = annotation.pdfplus()
+            start = temp_md.find("selection=") + len("selection=")
+            end = temp_md.find("|", start)
+            selection = temp_md[start:end]
+
+            if selection not in existing_selections:
+                unique_new_annotations.append(temp_md)
+                self.annotations.append(annotation)  # Add back to the session's annotations if it's new
+
+        if self.state is not None:
+            self.state.mark_emitted('pdfplus', [annotation.unique_id for annotation in current_annotations])
+
+        # Combine existing content with new unique annotations
+        if unique_new_annotations:
+            final_output = existing_content
+            if final_output and not final_output.endswith('\n\n'):
+                final_output += '\n\n'
+            final_output += '\n\n'.join(unique_new_annotations)
+
+            with open(output_file_name, 'w') as file:
+                file.write(final_output)
+            print(f"Annotation file updated with {len(unique_new_annotations)} new annotations. Total file: {output_file_name}.")
+        else:
+            print("No new annotations to add. File remains unchanged.")
+
+        return True
+
+    @output_format('markdown', aliases=('md',), anchors=('context',))
+    def convert_annotations_markdown(self):
+        print('Converting annotations (markdown).')
+        sorted_annotations = sorted(self.annotations, key=lambda x: x.page_number)
+
+        if self.args.template is None:
+            if self.file_type() == 'epub':
+                template = default_epub_markdown_template()
+            else:
+                template = default_markdown_template()
+        else:
+            with open(self.args.template, 'r') as file:
+                template = file.read()
+
+        template_parts = template.split('%annotation')
+
+        if len(template_parts) < 2:
+            print('A Markdown template must include a line containing just "%annotation". Everything before this line will be the global template, everything after will be repeated for each annotation. Exiting.')
+            sys.exit(0)
+
+        global_template = template_parts[0]
+
+        annotation_template = CompiledTemplate(template_parts[1])
+
+        last_slash_index = self.file_path.rfind('/')
+        if self.file_type() == "pdf":
+            output_file_name = self.file_path.replace('.pdf', '', 1) + '_anno.md'
+        elif self.file_type() == "epub":
+            output_file_name = self.file_path.replace('.epub', '', 1) + ' annotations.md'
+        with atomic_write(output_file_name) as file:
+            file.write(global_template.format(filename=os.path.basename(self.file_path), title=self.document.title, author=self.document.author))
+            for iteration, annotation in enumerate(sorted_annotations):
+                file.write(annotation.markdown(annotation_template, (iteration+1)))
+            file.write('\n')
+        print(f"Annotation file saved as {output_file_name}.")
+        return True
+
+    @output_format('bake', file_types=('pdf',), requires=('fitz', 'thefuzz.fuzz'), anchors=('rects',))
+    def convert_annotations_bake(self):
+        print('Converting annotations (bake).')
+        new_pdf_path = self.bake_output_path()
+        incremental = self.args.incremental and os.path.exists(new_pdf_path)
+        # Appending to the existing output leaves the source document untouched
+        doc = fitz.open(new_pdf_path) if incremental else self.pdf_context.fitz_doc
+        baked = 0
+        for annotation in self.pending_bake_annotations():
+            page = doc[annotation.page_number - 1]
+
+            if annotation.rects:
+                # One highlight covering a rectangle per line of the matched passage
+                highlight_annot = page.add_highlight_annot(annotation.rects)
+                # Recorded as the annotation's name (/NM), so later incremental runs know it is baked
+                doc.xref_set_key(highlight_annot.xref, "NM", fitz.get_pdf_str(BAKED_ID_PREFIX + annotation.unique_id))
+
+                # Calculate note position to be in the right margin but aligned with the first highlight
+                y_position = annotation.rects[0].y0  # Y-coordinate of the first highlight's top edge
+                x_position = page.rect.width - 60  # Assuming the note should be 60 units from the right edge
+                note_position = (x_position, y_position)
+
+                # Add one clickable note in the right margin for the highlight, holding the reader's note if there is one.
+                # Old bookmarks keep the highlighted passage itself in notes, so that never counts as a note.
+                body = annotation.notes if annotation.notes.strip() and annotation.notes != annotation.highlight else annotation.text
+                note = page.add_text_annot(note_position, body, icon="Comment")
+                note.set_info(content=body, title="kohico")
+                note.update()
+                baked += 1
+        if not incremental:
+            doc.save(new_pdf_path)
+            print(f"Annotated PDF saved as {new_pdf_path}.")
+        elif baked:
+            doc.save(new_pdf_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+            print(f"Appended {baked} new highlights to {new_pdf_path}.")
+        else:
+            print(f"No new highlights to bake. {new_pdf_path} remains unchanged.")
+        if incremental:
+            doc.close()
+        self.pdf_context.release_fitz_doc()
+
+    def bake_output_path(self):
+        return self.args.file_path.replace('.pdf', '_anno.pdf')
+
+    def pending_bake_annotations(self):
+        # With --incremental, highlights already named in the existing output are left alone
+        if not self.args.incremental or not os.path.exists(self.bake_output_path()):
+            return self.annotations
+        if self.baked_ids is None:
+            self.baked_ids = set()
+            with fitz.open(self.bake_output_path()) as doc:
+                for page in doc:
+                    for annot in page.annots(types=[fitz.PDF_ANNOT_HIGHLIGHT]):
+                        if annot.info['id'].startswith(BAKED_ID_PREFIX):
+                            self.baked_ids.add(annot.info['id'][len(BAKED_ID_PREFIX):])
+        return [annotation for annotation in self.annotations if annotation.unique_id not in self.baked_ids]
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Convert KOReader highlights, either by baking them into the PDF, converting for use with the Annotator plugin for Obsidian, or exporting to Markdown.")
+    parser.add_argument("file_path", help="Path to the PDF file. You can also give the path directly to a metadata.pdf.lua file, in which case not all output formats will be available.")
+    parser.add_argument("output_format", type=parse_choices, nargs='?', default='obsidian-annotator',
+                        help="Comma-separated types of output format(s) ('obsidian-annotator'/'obs' for Obsidian Annotator, 'bake' for baking into the PDF, 'markdown'/'md' for markdown output.). Default is 'obsidian-annotator,markdown'.")
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes that match highlights against the PDF text. Default is 1.')
+    parser.add_argument('--profile', type=str, default=None, metavar='REPORT', help='Write a JSON report with wall time and CPU time per stage, and time, candidate windows and score per highlight.')
+    parser.add_argument('--trace-memory', action='store_true', help='Add peak traced memory per stage to the --profile report. Tracing slows every stage down.')
+    parser.add_argument('--cprofile', type=str, default=None, metavar='DUMP', help='Also run under cProfile and dump its statistics here, for pstats or snakeviz.')
+    add_common_arguments(parser)
+    return parser
+
+def add_common_arguments(parser):
+    parser.add_argument('--template', type=str, help='Path to an optional Markdown template file.', default=None)
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the extraction cache in ~/.cache/kohico.')
+    parser.add_argument('--cache-size', type=int, help='Size cap for the extraction cache in megabytes. Default is 256.', default=CACHE_MAX_BYTES // (1024 * 1024))
+    parser.add_argument('--full', action='store_true', help='Ignore the kohico.state.json file in the .sdr directory and resolve every highlight again.')
+    parser.add_argument('--incremental', action='store_true', help='Bake only new highlights into an existing _anno.pdf, appended as an incremental update instead of rewriting the file.')
+    parser.add_argument('--text-backend', choices=['pdfjs', 'pymupdf'], default='pdfjs', help="Where pdf++ selection offsets come from: 'pdfjs' (node, exact) or 'pymupdf' (in-process approximation, no node needed). Default is 'pdfjs'.")
+
+PDF_ONLY_FORMATS = [key for key, entry in OUTPUT_FORMATS.items() if 'epub' not in entry['file_types']]
+EPUB_ONLY_FORMATS = [key for key, entry in OUTPUT_FORMATS.items() if 'pdf' not in entry['file_types']]
+
+def job_for_sidecar(lua_path, output_format):
+    """
+    Return the conversion job for one .sdr/metadata.{pdf,epub}.lua sidecar, or None if no format applies.
+    Books whose PDF/EPUB is missing fall back to the metadata file itself (markdown only), and formats
+    that do not apply to the book's type are dropped.
+    """
+    directory = os.path.dirname(lua_path)
+    book_type = 'epub' if lua_path.endswith('.epub.lua') else 'pdf'
+    book_path = directory[:-len('.sdr')] + '.' + book_type
+    if os.path.isfile(book_path):
+        job_path = book_path
+        unsupported = EPUB_ONLY_FORMATS if book_type == 'pdf' else PDF_ONLY_FORMATS
+        formats = [choice for choice in output_format if choice not in unsupported]
+    else:
+        job_path = lua_path
+        formats = [choice for choice in output_format if choice in ['markdown', 'md']]
+    if not formats:
+        return None
+    return {'file_path': job_path, 'lua_path': lua_path, 'output_format': formats}
+
+def find_batch_jobs(root, output_format):
+    """Walk a KOReader library and return one job per book that has a .sdr sidecar with metadata."""
+    jobs = []
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories.sort()
+        if not directory.endswith('.sdr'):
+            continue
+        for book_type in ['pdf', 'epub']:
+            lua_path = os.path.join(directory, f'metadata.{book_type}.lua')
+            if not os.path.isfile(lua_path):
+                continue
+            job = job_for_sidecar(lua_path, output_format)
+            if job:
+                jobs.append(job)
+    return jobs
+
+def job_args(job, common_args):
+    return argparse.Namespace(file_path=job['file_path'], output_format=job['output_format'], template=common_args.template, no_cache=common_args.no_cache, cache_size=common_args.cache_size, text_backend=common_args.text_backend, full=common_args.full, incremental=common_args.incremental, jobs=1, profile=None, cprofile=None, trace_memory=False)
+
+def run_batch_job(job, batch_args):
+    run_args = job_args(job, batch_args)
+    log = io.StringIO()
+    start_time = time.time()
+    error = None
+    try:
+        with contextlib.redirect_stdout(log):
+            KohicoSession(run_args).run()
+    except SystemExit:
+        error = log.getvalue().strip().splitlines()[-1] if log.getvalue().strip() else 'Exited early.'
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return {
+        'file_path': job['file_path'],
+        'output_format': job['output_format'],
+        'status': 'failed' if error else 'ok',
+        'error': error,
+        'seconds': round(time.time() - start_time, 3),
+    }
+
+def batch_main(argv):
+    parser = argparse.ArgumentParser(prog='kohico batch', description="Convert the highlights of every book with a .sdr sidecar below a KOReader library directory.")
+    parser.add_argument("root", help="Root directory of the KOReader library.")
+    parser.add_argument("output_format", type=parse_choices, nargs='?', default='markdown',
+                        help="Comma-separated output format(s), as for a single conversion. Formats that do not apply to a book are skipped for it. Default is 'markdown'.")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='Number of worker processes. Default is the number of CPUs.')
+    parser.add_argument('--report', type=str, default=None, help='Write a JSON summary report to this path.')
+    add_common_arguments(parser)
+    batch_args = parser.parse_args(argv)
+
+    jobs = find_batch_jobs(batch_args.root, batch_args.output_format)
+    print(f'Found {len(jobs)} books.')
+    start_time = time.time()
+    results = []
+    with futures.ProcessPoolExecutor(max_workers=max(1, batch_args.jobs)) as executor:
+        submitted = [executor.submit(run_batch_job, job, batch_args) for job in jobs]
+        for future in futures.as_completed(submitted):
+            result = future.result()
+            print(f"[{result['status']}] {result['file_path']} ({result['seconds']}s)" + (f": {result['error']}" if result['error'] else ''))
+            results.append(result)
+
+    results.sort(key=lambda result: result['file_path'])
+    failures = [result for result in results if result['status'] != 'ok']
+    report = {
+        'root': batch_args.root,
+        'books': len(results),
+        'succeeded': len(results) - len(failures),
+        'failed': len(failures),
+        'seconds': round(time.time() - start_time, 3),
+        'results': results,
+    }
+    print(f"Converted {report['succeeded']} of {report['books']} books in {report['seconds']}s, {report['failed']} failed.")
+    if batch_args.report:
+        with open(batch_args.report, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Report saved as {batch_args.report}.")
+    return report
+
+SIDECAR_NAME = re.compile(r'^metadata\.(pdf|epub)\.lua$')
+
+class InotifyWatcher:
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, root):
+        """
+        Recursive inotify watch for sidecar writes below root, through libc via ctypes.
+        Raises OSError where inotify is not available, so callers can fall back to PollingWatcher.
+        """
+        library = importlib.import_module('ctypes.util').find_library('c')
+        if not sys.platform.startswith('linux') or library is None:
+            raise OSError('inotify is not available on this platform')
+        self.libc = ctypes.CDLL(library, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}
+        for directory, _, _ in os.walk(root):
+            self.add_directory(directory)
+
+    def add_directory(self, directory):
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd >= 0:
+            self.directories[wd] = directory
+
+    def poll(self, timeout):
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+        buffer = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(buffer, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            directory = self.directories.get(wd)
+            if directory is None:
+                continue
+            if mask & self.IN_IGNORED:
+                del self.directories[wd]
+                continue
+            path = os.path.join(directory, name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    # A new (or moved in) directory may already contain sidecars
+                    for subdirectory, _, files in os.walk(path):
+                        self.add_directory(subdirectory)
+                        changed.update(os.path.join(subdirectory, file) for file in files if SIDECAR_NAME.match(file))
+            elif SIDECAR_NAME.match(name) and mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    def __init__(self, root, interval):
+        """Fallback watcher that rescans root for sidecar changes every interval seconds."""
+        self.root = root
+        self.interval = interval
+        self.mtimes = self.scan()
+
+    def scan(self):
+        mtimes = {}
+        for directory, _, files in os.walk(self.root):
+            for file in files:
+                if SIDECAR_NAME.match(file):
+                    path = os.path.join(directory, file)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    mtimes[path] = (stat.st_mtime_ns, stat.st_size)
+        return mtimes
+
+    def poll(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        mtimes = self.scan()
+        changed = {path for path, mtime in mtimes.items() if self.mtimes.get(path) != mtime}
+        self.mtimes = mtimes
+        return changed
+
+    def close(self):
+        pass
+
+class PdfContextPool:
+    def __init__(self, cache=None, text_backend='pdfjs', size=4):
+        """
+        Keeps the PdfContexts of the size most recently converted PDFs open between watch events. The least recently
+        used one is closed when another is opened, and a context is replaced once its file changes on disk.
+        """
+        self.cache = cache
+        self.text_backend = text_backend
+        self.size = size
+        self.contexts = collections.OrderedDict()
+
+    def get(self, path):
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        if path in self.contexts and self.contexts[path][0] != key:
+            self.contexts.pop(path)[1].close()
+        if path not in self.contexts:
+            self.contexts[path] = (key, PdfContext(path, self.cache, self.text_backend))
+            while len(self.contexts) > self.size:
+                self.contexts.popitem(last=False)[1][1].close()
+        self.contexts.move_to_end(path)
+        return self.contexts[path][1]
+
+    def close(self):
+        for _, pdf_context in self.contexts.values():
+            pdf_context.close()
+        self.contexts.clear()
+
+def watch_main(argv):
+    parser = argparse.ArgumentParser(prog='kohico watch', description="Watch a KOReader library and reconvert a book whenever its .sdr metadata changes.")
+    parser.add_argument("root", help="Root directory of the KOReader library.")
+    parser.add_argument("output_format", type=parse_choices, nargs='?', default='markdown',
+                        help="Comma-separated output format(s), as for a single conversion. Formats that do not apply to a book are skipped for it. Default is 'markdown'.")
+    parser.add_argument('--debounce', type=float, default=2.0, help='Seconds a sidecar must stay unchanged before it is converted. Default is 2.')
+    parser.add_argument('--interval', type=float, default=5.0, help='Rescan interval in seconds when polling. Default is 5.')
+    parser.add_argument('--poll', action='store_true', help='Poll for changes even where inotify is available.')
+    add_common_arguments(parser)
+    watch_args = parser.parse_args(argv)
+
+    watcher = None
+    if not watch_args.poll:
+        try:
+            watcher = InotifyWatcher(watch_args.root)
+        except OSError as e:
+            print(f'inotify unavailable ({e}), polling instead.')
+    if watcher is None:
+        watcher = PollingWatcher(watch_args.root, watch_args.interval)
+
+    # Kept warm between events: one extraction cache and the opened PdfContexts of the last few books
+    cache = None if watch_args.no_cache else ExtractionCache(max_bytes=watch_args.cache_size * 1024 * 1024)
+    pdf_contexts = PdfContextPool(cache, watch_args.text_backend)
+    pending = {}
+
+    def convert_sidecar(lua_path):
+        job = job_for_sidecar(lua_path, watch_args.output_format)
+        if job is None or not os.path.isfile(lua_path):
+            return
+        start_time = time.time()
+        try:
+            pdf_context = None
+            if job['file_path'].endswith('.pdf'):
+                pdf_context = pdf_contexts.get(job['file_path'])
+            with contextlib.redirect_stdout(io.StringIO()):
+                KohicoSession(job_args(job, watch_args), pdf_context).run()
+            print(f"[ok] {job['file_path']} ({round(time.time() - start_time, 3)}s)")
+        except (Exception, SystemExit) as e:
+            print(f"[failed] {job['file_path']}: {type(e).__name__}: {e}")
+        if cache is not None:
+            cache.flush()
+
+    print(f'Watching {watch_args.root} for KOReader metadata changes. Press Ctrl+C to stop.')
+    try:
+        while True:
+            timeout = watch_args.debounce if pending else watch_args.interval
+            for path in watcher.poll(timeout):
+                pending[path] = time.time()
+            now = time.time()
+            for path, changed_at in sorted(pending.items()):
+                if now - changed_at >= watch_args.debounce:
+                    del pending[path]
+                    convert_sidecar(path)
+    except KeyboardInterrupt:
+        print('Stopped watching.')
+    finally:
+        watcher.close()
+        pdf_contexts.close()
+        if cache is not None:
+            cache.close()
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        batch_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'watch':
+        watch_main(sys.argv[2:])
+        return
+    KohicoSession(build_parser().parse_args()).run()
+
+
+if __name__ == "__main__":
+    main()
+
+
+
+
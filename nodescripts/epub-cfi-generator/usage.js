@@ -12,7 +12,7 @@ const EpubCfiGenerator = require('./epub-cfi-generator');
   }
 
   new EpubCfiGenerator().parse(inputFile).then((spinesInfo) => {
-    const serialized = JSON.stringify(spinesInfo, null, 4);
+    const serialized = JSON.stringify(spinesInfo);
 		console.log(serialized);
   }).catch((err) => console.error(`${err}\x07`));
 })();
@@ -1,4 +1,5 @@
-import { readFileSync } from 'fs';
+import { readFileSync, statSync } from 'fs';
+import { createInterface } from 'readline';
 import { JSDOM } from 'jsdom';
 import * as pdfjsLib from 'pdfjs-dist/legacy/build/pdf.mjs';
 import { fileURLToPath } from 'url';
@@ -32,20 +33,24 @@ pdfjsLib.GlobalWorkerOptions.workerSrc = new URL('file://' + workerPath).href;
 // Parse CLI args
 const [,, pdfPath, pageSpec] = process.argv;
 if (!pdfPath) {
-  console.error('Usage: node extract-pdf-text.js <pdfPath> [pageSpec]');
+  console.error('Usage: node extract-pdf-text.js <pdfPath> [pageSpec]   (pageSpec: N, A-B or N,M,...)');
+  console.error('       node extract-pdf-text.js --serve');
   process.exit(1);
 }
 
-async function extractTextFromPdf(pathToPdf, pageSpec) {
-  const data = new Uint8Array(readFileSync(pathToPdf));
-  const doc = await pdfjsLib.getDocument({ data }).promise;
-  const numPages = doc.numPages;
-  const allPagesContent = [];
-
+function resolvePages(numPages, pageSpec) {
   let startPage = 1;
   let endPage = numPages;
 
-  if (pageSpec && /^\d+$/.test(pageSpec)) {
+  if (typeof pageSpec === 'string' && /^\d+(,\d+)+$/.test(pageSpec)) {
+    pageSpec = pageSpec.split(',');
+  }
+
+  if (Array.isArray(pageSpec)) {
+    return [...new Set(pageSpec.map(x => parseInt(x)))]
+      .filter(page => page >= 1 && page <= numPages)
+      .sort((a, b) => a - b);
+  } else if (pageSpec && /^\d+$/.test(pageSpec)) {
     startPage = endPage = Math.max(1, Math.min(numPages, parseInt(pageSpec)));
   } else if (pageSpec && /^\d+-\d+$/.test(pageSpec)) {
     const [start, end] = pageSpec.split("-").map(x => parseInt(x));
@@ -53,7 +58,19 @@ async function extractTextFromPdf(pathToPdf, pageSpec) {
     endPage = Math.min(numPages, end);
   }
 
+  const pages = [];
   for (let i = startPage; i <= endPage; i++) {
+    pages.push(i);
+  }
+  return pages;
+}
+
+async function extractTextFromPdf(pathToPdf, pageSpec) {
+  const data = new Uint8Array(readFileSync(pathToPdf));
+  const doc = await pdfjsLib.getDocument({ data }).promise;
+  const allPagesContent = [];
+
+  for (const i of resolvePages(doc.numPages, pageSpec)) {
     const page = await doc.getPage(i);
     const content = await page.getTextContent();
     allPagesContent.push({ page: i, content });
@@ -62,14 +79,70 @@ async function extractTextFromPdf(pathToPdf, pageSpec) {
   return allPagesContent;
 }
 
-extractTextFromPdf(pdfPath, pageSpec)
-  .then(content => {
-		// Restore the original stdout write function
-		process.stdout.write = originalStdoutWrite;
-    console.log(JSON.stringify(content));
-  })
-  .catch(err => {
-    console.error("Error extracting PDF text:", err.stack || err);
-    process.exit(1);
+function writeLine(message) {
+  originalStdoutWrite.call(process.stdout, JSON.stringify(message) + '\n');
+}
+
+// Worker mode: one JSON request per stdin line ({"path": ..., "pages": [...] | "N" | "A-B" | null}),
+// answered by one JSON line per page and a closing {"done": true}. The most recently used document
+// stays open, so repeated requests for the same book skip parsing it again.
+function serve() {
+  let current = null;
+  let queue = Promise.resolve();
+
+  async function openDocument(pathToPdf) {
+    const mtime = statSync(pathToPdf).mtimeMs;
+    if (current && current.path === pathToPdf && current.mtime === mtime) {
+      return current.doc;
+    }
+    if (current) {
+      await current.doc.destroy();
+      current = null;
+    }
+    const data = new Uint8Array(readFileSync(pathToPdf));
+    const doc = await pdfjsLib.getDocument({ data }).promise;
+    current = { path: pathToPdf, mtime, doc };
+    return doc;
+  }
+
+  async function handleRequest(line) {
+    if (!line.trim()) {
+      return;
+    }
+    try {
+      const request = JSON.parse(line);
+      const doc = await openDocument(request.path);
+      for (const i of resolvePages(doc.numPages, request.pages)) {
+        const page = await doc.getPage(i);
+        const content = await page.getTextContent();
+        writeLine({ page: i, content });
+      }
+      writeLine({ done: true });
+    } catch (err) {
+      writeLine({ done: true, error: String(err.stack || err) });
+    }
+  }
+
+  const lines = createInterface({ input: process.stdin });
+  lines.on('line', (line) => {
+    queue = queue.then(() => handleRequest(line));
   });
+  lines.on('close', () => {
+    queue.then(() => process.exit(0));
+  });
+}
 
+if (pdfPath === '--serve') {
+  serve();
+} else {
+  extractTextFromPdf(pdfPath, pageSpec)
+    .then(content => {
+      // Restore the original stdout write function
+      process.stdout.write = originalStdoutWrite;
+      console.log(JSON.stringify(content));
+    })
+    .catch(err => {
+      console.error("Error extracting PDF text:", err.stack || err);
+      process.exit(1);
+    });
+}
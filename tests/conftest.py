@@ -0,0 +1,14 @@
+import argparse
+import os
+import sys
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+sys.path.insert(0, os.path.join(REPOSITORY, 'benchmarks'))
+
+
+def session_args(file_path, output_format, **overrides):
+    values = dict(file_path=str(file_path), output_format=list(output_format), template=None, no_cache=True, cache_size=256,
+                  text_backend='pymupdf', full=False, incremental=False, jobs=1, profile=None, cprofile=None, trace_memory=False)
+    values.update(overrides)
+    return argparse.Namespace(**values)
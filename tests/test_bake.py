@@ -0,0 +1,25 @@
+import contextlib
+import io
+
+import fitz
+
+import corpus
+import kohicolib
+from conftest import session_args
+
+
+def test_baked_notes_hold_the_readers_note(tmp_path):
+    pdf_path = tmp_path / 'book.pdf'
+    corpus.generate_pdf(str(pdf_path), 4, 12, ocr_rate=0)
+    metadata = kohicolib.load_metadata_lua(str(tmp_path / 'book.sdr' / 'metadata.pdf.lua'))
+    expected = {annotation['text']: annotation.get('note', annotation['text']) for annotation in metadata['annotations']}
+    assert any('note' in annotation for annotation in metadata['annotations'])
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        kohicolib.KohicoSession(session_args(pdf_path, ['bake'])).run()
+
+    baked = fitz.open(str(tmp_path / 'book_anno.pdf'))
+    bodies = [annot.info['content'] for page in baked for annot in page.annots() if annot.type[1] == 'Text']
+    assert len(bodies) == len(expected)
+    assert sorted(bodies) == sorted(expected.values())
+    baked.close()
@@ -0,0 +1,33 @@
+import time
+
+import kohicolib
+
+
+def test_writers_do_not_block_each_other(tmp_path):
+    first = kohicolib.ExtractionCache(str(tmp_path))
+    second = kohicolib.ExtractionCache(str(tmp_path))
+    second.connection.execute('PRAGMA busy_timeout = 1000')
+
+    first.register('a', '/books/a.pdf')
+    first.put('a', 'text:1', 'first')
+    start = time.perf_counter()
+    second.register('b', '/books/b.pdf')
+    second.put_many('b', [('text:1', 'second'), ('text:2', 'third')])
+    assert time.perf_counter() - start < 0.5
+
+    assert first.get('b', 'text:2') == 'third'
+    assert second.get('a', 'text:1') == 'first'
+    first.close()
+    second.close()
+
+
+def test_eviction_drops_least_recently_used_documents(tmp_path):
+    cache = kohicolib.ExtractionCache(str(tmp_path), max_bytes=100)
+    cache.register('old', '/books/old.pdf')
+    cache.put('old', 'text:1', 'x' * 80)
+    cache.register('new', '/books/new.pdf')
+    cache.put('new', 'text:1', 'y' * 80)
+    cache.flush()
+    assert cache.get('old', 'text:1') is None
+    assert cache.get('new', 'text:1') == 'y' * 80
+    cache.close()
@@ -0,0 +1,91 @@
+import json
+import os
+import re
+import zipfile
+
+import corpus
+import kohicolib
+from conftest import REPOSITORY
+
+TESTBOOKS = os.path.join(REPOSITORY, 'nodescripts', 'epub-cfi-generator', 'testbooks')
+
+
+def test_cfi_map_matches_node_generator_fixture():
+    with open(os.path.join(TESTBOOKS, 'minimal-output.json'), encoding='utf-8') as file:
+        expected = json.load(file)
+
+    cfi_map = kohicolib.generate_cfi_map(os.path.join(TESTBOOKS, 'minimal.epub'))
+
+    assert [(spine['idref'], spine['href']) for spine in cfi_map['spines']] == [(spine['idref'], spine['href']) for spine in expected]
+    for spine, expected_spine in zip(cfi_map['spines'], expected):
+        assert [(node['node'], node['cfi']) for node in spine['content']] == [(node['node'], node['cfi']) for node in expected_spine['content']]
+
+
+def test_cfi_map_offsets_index_full_text():
+    cfi_map = kohicolib.generate_cfi_map(os.path.join(TESTBOOKS, 'minimal.epub'))
+
+    for spine in cfi_map['spines']:
+        for node in spine['content']:
+            assert cfi_map['full_text'][node['offset'] - 1:node['offset'] - 1 + node['length']] == node['node']
+
+
+def test_text_index_is_built_only_for_searched_highlights(tmp_path):
+    epub_path = str(tmp_path / 'novel.epub')
+    corpus.generate_epub(epub_path, 3, 10, ocr_rate=0)
+    metadata = kohicolib.load_metadata_lua(str(tmp_path / 'novel.sdr' / 'metadata.epub.lua'))
+    generator = kohicolib.CFIGenerator(kohicolib.generate_cfi_map(epub_path), metadata['stats']['pages'])
+
+    cfis = [generator.generate_cfi_range(annotation) for annotation in metadata['annotations']]
+    assert cfis == [generator.xpointer_cfi_range(annotation) for annotation in metadata['annotations']]
+    assert all(re.fullmatch(r'epubcfi\(/6/\d+!/4/\d+,/1:\d+,/1:\d+\)', cfi) for cfi in cfis)
+    assert generator.text_index is None
+
+    assert generator.generate_cfi_range(dict(metadata['annotations'][0], pos0=None, pos1=None)) == cfis[0]
+    assert generator.text_index is not None
+
+
+def write_epub(path, body):
+    with zipfile.ZipFile(path, 'w') as epub:
+        epub.writestr('mimetype', 'application/epub+zip')
+        epub.writestr('META-INF/container.xml', '<?xml version="1.0"?>\n<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles><rootfile full-path="content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>')
+        epub.writestr('content.opf', '<?xml version="1.0"?>\n<package xmlns="http://www.idpf.org/2007/opf" version="3.0"><manifest><item id="text" href="text.xhtml" media-type="application/xhtml+xml"/></manifest><spine><itemref idref="text"/></spine></package>')
+        epub.writestr('text.xhtml', f'<?xml version="1.0"?>\n<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Text</title></head><body>{body}</body></html>')
+
+
+def test_xpointer_offsets_count_collapsed_whitespace(tmp_path):
+    paragraph = '\n        Labour and\n        capital theory, as the classical economists\n        understood it.\n      '
+    epub_path = str(tmp_path / 'book.epub')
+    write_epub(epub_path, f'\n    <p>{paragraph}</p>\n  ')
+    generator = kohicolib.CFIGenerator(kohicolib.generate_cfi_map(epub_path), 1)
+    highlight = 'capital theory, as the classical economists understood'
+    # crengine drops the whitespace a block starts with and collapses every other run to one space
+    collapsed = ' '.join(paragraph.split())
+    start = collapsed.index(highlight)
+    annotation = {'text': highlight, 'pageno': 1,
+                  'pos0': f'/body/DocFragment[1]/body/p/text().{start}', 'pos1': f'/body/DocFragment[1]/body/p/text().{start + len(highlight)}'}
+
+    raw_start = paragraph.index('capital')
+    raw_end = paragraph.index('understood') + len('understood')
+    assert generator.xpointer_cfi_range(annotation) == f'epubcfi(/4/2!/4/2,/1:{raw_start},/1:{raw_end})'
+
+    # A range shifted by two characters is not taken for the highlight
+    shifted = dict(annotation, pos0=f'/body/DocFragment[1]/body/p/text().{start + 2}', pos1=f'/body/DocFragment[1]/body/p/text().{start + len(highlight) + 2}')
+    assert generator.xpointer_cfi_range(shifted) is None
+
+
+def test_searched_highlights_get_their_xpointer_cfi(tmp_path):
+    epub_path = str(tmp_path / 'novel.epub')
+    corpus.generate_epub(epub_path, 4, 60, ocr_rate=0)
+    metadata = kohicolib.load_metadata_lua(str(tmp_path / 'novel.sdr' / 'metadata.epub.lua'))
+    generator = kohicolib.CFIGenerator(kohicolib.generate_cfi_map(epub_path), metadata['stats']['pages'])
+
+    for annotation in metadata['annotations']:
+        expected = generator.xpointer_cfi_range(annotation)
+        assert expected is not None
+        assert generator.generate_cfi_range(dict(annotation, pos0=None, pos1=None)) == expected
+
+
+def test_searched_range_keeps_element_ids():
+    generator = kohicolib.CFIGenerator(kohicolib.generate_cfi_map(os.path.join(TESTBOOKS, 'minimal.epub')), 1)
+
+    assert generator.generate_cfi_range({'text': 'yyy0123456789', 'pageno': 1}) == 'epubcfi(/6/2[testref]!/4[body01]/10[para05],/2/1:0,/3:10)'
@@ -0,0 +1,37 @@
+import contextlib
+import importlib
+import io
+
+import pytest
+
+import corpus
+import kohicolib
+from conftest import session_args
+
+
+def test_markdown_declares_what_resolving_context_needs():
+    assert kohicolib.format_requirements('md') == ['PyPDF2', 'thefuzz.fuzz']
+    # A metadata file passed directly and EPUBs resolve no anchors, so markdown needs nothing then
+    assert kohicolib.format_requirements('md', resolve_anchors=False) == []
+    assert kohicolib.format_requirements('bake', resolve_anchors=False) == ['fitz', 'thefuzz.fuzz']
+
+
+def test_pymupdf_backend_requires_fitz_for_selections(tmp_path, monkeypatch):
+    assert kohicolib.format_requirements('pdfplus') == ['thefuzz.fuzz']
+    assert kohicolib.format_requirements('pdfplus', text_backend='pymupdf') == ['thefuzz.fuzz', 'fitz']
+
+    pdf_path = tmp_path / 'book.pdf'
+    corpus.generate_pdf(str(pdf_path), 2, 4)
+    import_module = importlib.import_module
+
+    def without_fitz(name, *args, **kwargs):
+        if name == 'fitz':
+            raise ImportError(name)
+        return import_module(name, *args, **kwargs)
+
+    monkeypatch.setattr(importlib, 'import_module', without_fitz)
+    output = io.StringIO()
+    session = kohicolib.KohicoSession(session_args(pdf_path, ['pdfplus'], text_backend='pymupdf'))
+    with contextlib.redirect_stdout(output), pytest.raises(SystemExit):
+        session.prepare()
+    assert "The pdfplus output format needs the Python module 'fitz'." in output.getvalue()
@@ -0,0 +1,59 @@
+import random
+import string
+
+import pytest
+
+import kohicolib
+
+WORDS = ('the', 'of', 'reading', 'margin', 'highlight', 'page', 'which', 'note', 'kobo', 'sidecar', 'annotation',
+         'chapter', 'document', 'selection', 'text', 'and', 'when', 'every', 'window', 'offset', 'ligature', 'Istanbul')
+
+
+def noisy_page(rng, length):
+    words = []
+    while sum(len(word) + 1 for word in words) < length:
+        word = rng.choice(WORDS)
+        words.append(word.capitalize() if rng.random() < 0.1 else word)
+    return ' '.join(words)
+
+
+def add_noise(rng, text, edits):
+    # KOReader selections drift from the PDF text by hyphenation, dropped spaces and OCR-style substitutions
+    characters = list(text)
+    for _ in range(edits):
+        position = rng.randrange(len(characters))
+        edit = rng.choice(('substitute', 'delete', 'insert', 'hyphenate'))
+        if edit == 'substitute':
+            characters[position] = rng.choice(string.ascii_lowercase)
+        elif edit == 'delete' and len(characters) > 1:
+            del characters[position]
+        elif edit == 'insert':
+            characters.insert(position, rng.choice(string.ascii_lowercase + ' '))
+        else:
+            characters.insert(position, '-')
+    return ''.join(characters)
+
+
+def window_bounds(target):
+    return max(1, int(len(target) * 0.75)), int(len(target) * 1.25)
+
+
+@pytest.mark.parametrize('seed', range(12))
+def test_anchored_search_matches_exhaustive_search(seed):
+    rng = random.Random(seed)
+    page = noisy_page(rng, rng.randrange(600, 1500))
+    start = rng.randrange(0, len(page) - 120)
+    target = add_noise(rng, page[start:start + rng.randrange(20, 100)], rng.randrange(0, 6)).lower()
+    min_len, max_len = window_bounds(target)
+
+    expected = kohicolib.find_best_window_exhaustive(page, target, min_len, max_len)
+    assert kohicolib.find_best_window(page, target, min_len, max_len) == expected
+
+
+@pytest.mark.parametrize('target', ['istanbul margin', 'reading the note', 'x'])
+def test_exact_and_short_targets_match_exhaustive_search(target):
+    page = noisy_page(random.Random(target), 800) + ' Reading the note of İstanbul margin'
+    min_len, max_len = window_bounds(target)
+
+    expected = kohicolib.find_best_window_exhaustive(page, target, min_len, max_len)
+    assert kohicolib.find_best_window(page, target, min_len, max_len) == expected
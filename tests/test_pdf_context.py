@@ -0,0 +1,41 @@
+import os
+import tracemalloc
+
+import fitz
+
+import corpus
+import kohicolib
+
+
+def test_large_pdf_is_not_read_into_memory(tmp_path):
+    pdf_path = str(tmp_path / 'scan.pdf')
+    corpus.generate_pdf(pdf_path, 3, 2)
+    # Stands in for the page images of a scanned book
+    document = fitz.open(pdf_path)
+    document.embfile_add('scan.bin', os.urandom(8 * 1024 * 1024))
+    document.saveIncr()
+    document.close()
+    size = os.path.getsize(pdf_path)
+
+    # The same steps on a small PDF import the lazily loaded modules, so only the reading is measured
+    warm_path = str(tmp_path / 'warm.pdf')
+    corpus.generate_pdf(warm_path, 1, 1)
+    warm = kohicolib.PdfContext(warm_path, text_backend='pymupdf')
+    warm.fingerprint
+    warm.page_text(1)
+    warm.text_content(1)
+    warm.close()
+
+    context = kohicolib.PdfContext(pdf_path, text_backend='pymupdf')
+    tracemalloc.start()
+    try:
+        context.fingerprint
+        context.page_text(1)
+        context.text_content(1)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        context.close()
+
+    assert size > 8 * 1024 * 1024
+    assert peak < size // 4
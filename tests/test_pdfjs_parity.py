@@ -0,0 +1,35 @@
+import os
+import shutil
+
+import pytest
+
+import corpus
+import kohicolib
+from conftest import REPOSITORY
+
+pytestmark = pytest.mark.skipif(shutil.which('node') is None or not os.path.isdir(os.path.join(REPOSITORY, 'nodescripts', 'node_modules')),
+                                reason='needs node and npm install in nodescripts')
+
+
+def item_shapes(pages):
+    return {page['page']: [(item['str'], item['hasEOL']) for item in page['content']['items']] for page in pages}
+
+
+def test_pymupdf_items_match_pdfjs(tmp_path):
+    pdf_path = str(tmp_path / 'book.pdf')
+    corpus.generate_pdf(pdf_path, 5, 10, seed=3)
+    pages = [1, 2, 3, 4, 5]
+    pdfjs = item_shapes(kohicolib.get_pdfjs_text_content(pdf_path, pages))
+    pymupdf = item_shapes(kohicolib.get_pymupdf_text_content(kohicolib.PdfContext(pdf_path), pages))
+    assert pymupdf == pdfjs
+
+
+def test_pymupdf_selections_match_pdfjs(tmp_path):
+    pdf_path = str(tmp_path / 'book.pdf')
+    corpus.generate_pdf(pdf_path, 5, 20, seed=4)
+    metadata = kohicolib.load_metadata_lua(str(tmp_path / 'book.sdr' / 'metadata.pdf.lua'))
+    pdfjs_context = kohicolib.PdfContext(pdf_path, text_backend='pdfjs')
+    pymupdf_context = kohicolib.PdfContext(pdf_path, text_backend='pymupdf')
+    for annotation in metadata['annotations']:
+        expected = kohicolib.find_string(pdfjs_context.text_content(annotation['page']), annotation['text'])
+        assert kohicolib.find_string(pymupdf_context.text_content(annotation['page']), annotation['text']) == expected
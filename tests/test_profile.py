@@ -0,0 +1,39 @@
+import contextlib
+import io
+import json
+import os
+import tracemalloc
+
+import corpus
+import kohicolib
+from conftest import session_args
+
+
+def profile_run(tmp_path, **overrides):
+    os.makedirs(tmp_path / '.obsidian', exist_ok=True)
+    pdf_path = tmp_path / 'book.pdf'
+    if not pdf_path.exists():
+        corpus.generate_pdf(str(pdf_path), 3, 4)
+    report_path = tmp_path / 'report.json'
+    with contextlib.redirect_stdout(io.StringIO()):
+        kohicolib.KohicoSession(session_args(pdf_path, ['markdown'], profile=str(report_path), **overrides)).run()
+    with open(report_path) as file:
+        return json.load(file)
+
+
+def test_profile_does_not_trace_memory_by_default(tmp_path):
+    report = profile_run(tmp_path)
+
+    stages = [stage['stage'] for stage in report['stages']]
+    assert stages.index('imports') < stages.index('lua_to_json')
+    assert report['peak_traced_bytes'] is None
+    assert all('peak_traced_bytes' not in stage for stage in report['stages'])
+    assert not tracemalloc.is_tracing()
+
+
+def test_trace_memory_adds_peaks(tmp_path):
+    report = profile_run(tmp_path, trace_memory=True)
+
+    assert report['peak_traced_bytes'] > 0
+    assert all(stage['peak_traced_bytes'] >= 0 for stage in report['stages'])
+    assert not tracemalloc.is_tracing()
@@ -0,0 +1,42 @@
+import contextlib
+import io
+import os
+
+import corpus
+import kohicolib
+from conftest import session_args
+
+
+def run_session(args):
+    session = kohicolib.KohicoSession(args)
+    with contextlib.redirect_stdout(io.StringIO()):
+        session.prepare()
+        session.finish()
+    return session
+
+
+def test_epub_state_lives_in_each_sidecar(tmp_path):
+    for name in ('first', 'second'):
+        corpus.generate_epub(str(tmp_path / f'{name}.epub'), 2, 5, seed=len(name))
+        run_session(session_args(tmp_path / f'{name}.epub', ['markdown']))
+
+    assert not (tmp_path / 'kohico.state.json').exists()
+    assert (tmp_path / 'first.sdr' / 'kohico.state.json').exists()
+    assert (tmp_path / 'second.sdr' / 'kohico.state.json').exists()
+
+
+def test_edited_note_is_resolved_again(tmp_path):
+    os.makedirs(tmp_path / '.obsidian')
+    pdf_path = tmp_path / 'book.pdf'
+    corpus.generate_pdf(str(pdf_path), 3, 4, seed=1)
+    run_session(session_args(pdf_path, ['obsidian-annotator']))
+
+    lua_path = tmp_path / 'book.sdr' / 'metadata.pdf.lua'
+    metadata = kohicolib.load_metadata_lua(str(lua_path))
+    metadata['annotations'][0]['note'] = metadata['annotations'][0]['text']
+    corpus.write_metadata(str(tmp_path / 'book.sdr'), 'pdf', metadata)
+
+    incremental = run_session(session_args(pdf_path, ['obsidian-annotator']))
+    full = run_session(session_args(pdf_path, ['obsidian-annotator'], full=True))
+    assert incremental.annotations[0].context == full.annotations[0].context
+    assert incremental.annotations[0].context['start_pos'] != 'na'
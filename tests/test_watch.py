@@ -0,0 +1,37 @@
+import os
+
+import corpus
+import kohicolib
+
+
+def test_pool_closes_least_recently_used_contexts(tmp_path):
+    paths = []
+    for name in ('a', 'b', 'c'):
+        paths.append(str(tmp_path / f'{name}.pdf'))
+        corpus.generate_pdf(paths[-1], 2, 1, seed=len(paths))
+    pool = kohicolib.PdfContextPool(text_backend='pymupdf', size=2)
+
+    first = pool.get(paths[0])
+    second = pool.get(paths[1])
+    second.fitz_doc
+    assert pool.get(paths[0]) is first
+    pool.get(paths[2])
+
+    assert list(pool.contexts) == [paths[0], paths[2]]
+    assert second._fitz_doc is None and second._file is None
+    first.fitz_doc
+    pool.close()
+    assert first._fitz_doc is None and first._file is None
+
+def test_pool_reopens_changed_files(tmp_path):
+    path = str(tmp_path / 'book.pdf')
+    corpus.generate_pdf(path, 2, 1)
+    pool = kohicolib.PdfContextPool(text_backend='pymupdf')
+    before = pool.get(path)
+    before.fitz_doc
+
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert pool.get(path) is not before
+    assert before._fitz_doc is None
+    pool.close()